@@ -1,4 +1,6 @@
 import asyncio
+from functools import lru_cache
+from typing import List, Set
 
 from fastapi import APIRouter
 from fastapi.staticfiles import StaticFiles
@@ -21,17 +23,38 @@ bets4sats_static_files = [
 ]
 
 
+@lru_cache(maxsize=1)
 def bets4sats_renderer():
+    # Built once, on first use after lnbits settings are loaded
     return template_renderer(["lnbits/extensions/bets4sats/templates"])
 
 
+from .helpers import start_http_client, close_http_client
 from .tasks import wait_for_paid_invoices, wait_for_reward_ticket_ids, purge_tickets_loop
 from .views import *  # noqa: F401,F403
 from .views_api import *  # noqa: F401,F403
 
+scheduled_tasks: List[asyncio.Task] = []
+# Keeps a reference to the client shutdown until it is done
+shutdown_tasks: Set[asyncio.Task] = set()
+
 
 def bets4sats_start():
     loop = asyncio.get_event_loop()
-    loop.create_task(catch_everything_and_restart(wait_for_paid_invoices))
-    loop.create_task(catch_everything_and_restart(wait_for_reward_ticket_ids))
-    loop.create_task(catch_everything_and_restart(purge_tickets_loop))
+    start_http_client()
+    scheduled_tasks.append(loop.create_task(catch_everything_and_restart(wait_for_paid_invoices)))
+    scheduled_tasks.append(loop.create_task(catch_everything_and_restart(wait_for_reward_ticket_ids)))
+    scheduled_tasks.append(loop.create_task(catch_everything_and_restart(purge_tickets_loop)))
+
+
+def bets4sats_stop():
+    for task in scheduled_tasks:
+        task.cancel()
+    scheduled_tasks.clear()
+    loop = asyncio.get_event_loop()
+    if loop.is_running():
+        task = loop.create_task(close_http_client())
+        shutdown_tasks.add(task)
+        task.add_done_callback(shutdown_tasks.discard)
+    else:
+        loop.run_until_complete(close_http_client())
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from typing import Dict, Generic, Optional, TypeVar
+import time
+
+V = TypeVar("V")
+
+
+class LruTtlCache(Generic[V]):
+    """
+    Bounded in-process cache, evicting the least recently used entry when full and
+    dropping entries older than ttl seconds.
+
+    A value read from the database before a concurrent write may be set after the write
+    invalidated its key. To drop such stale fills, take version() before reading and pass
+    it to set(), which ignores the value if the key was invalidated since.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple[float, V]]" = OrderedDict()
+        # Version at which each key was last invalidated, bounded like the entries: a fill
+        # older than a forgotten invalidation is dropped whatever its key
+        self._version = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._forgotten_version = 0
+
+    def get(self, key: str) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def version(self) -> int:
+        return self._version
+
+    def set(self, key: str, value: V, ttl: Optional[float] = None, version: Optional[int] = None) -> None:
+        if version is not None and (
+            self._invalidated.get(key, 0) > version or self._forgotten_version > version
+        ):
+            return
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        self._entries.pop(key, None)
+        self._version += 1
+        self._invalidated[key] = self._version
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.max_size:
+            _key, forgotten_version = self._invalidated.popitem(last=False)
+            self._forgotten_version = max(self._forgotten_version, forgotten_version)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._version += 1
+        self._invalidated.clear()
+        self._forgotten_version = self._version
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,158 +1,373 @@
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 import json
 import datetime
+import hashlib
+import heapq
+import itertools
+import time
 
 import shortuuid
 from lnbits.helpers import urlsafe_short_hash
 
-from . import db
-from .models import ChoiceAmountSum, CreateCompetition, Competition, Ticket, UpdateCompetition
+from . import db, metrics
+from .cache import LruTtlCache
+from .models import ChoiceAmountSum, ChoiceTotal, CreateCompetition, Competition, Payout, Ticket, TicketCount, UpdateCompetition
+
+# Histogram of the latency of the public crud functions, labelled by function name
+CRUD_SECONDS = "bets4sats_crud_seconds"
+CRUD_SECONDS_HELP = "Latency of crud functions"
 
 # TICKETS
 
 INVOICE_EXPIRY = 15 * 60 # 15 minutes
 TICKET_PURGE_TIME = INVOICE_EXPIRY + 10 # safety 10 seconds more than ticket expiry
 
-async def create_ticket(
-    ticket_id: str, wallet: str, competition: str, amount: int, reward_target: str,
-    choice: int,
-) -> Ticket:
-    await db.execute(
-        """
-        INSERT INTO bets4sats.tickets (id, wallet, competition, amount, reward_target, choice, state, reward_msat, reward_failure, reward_payment_hash)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+COMPETITION_CACHE_SIZE = 1000
+COMPETITION_CACHE_TTL = 10 # seconds, bounds staleness when running several processes
+
+# Ticket states counted in competitions.outstanding_payouts
+OUTSTANDING_PAYOUT_STATES = ("WON_UNPAID", "WON_PAYING", "CANCELLED_UNPAID", "CANCELLED_PAYING")
+
+# Every function here that writes to competitions or choices must invalidate its entry
+competition_cache: LruTtlCache[Competition] = LruTtlCache(COMPETITION_CACHE_SIZE, COMPETITION_CACHE_TTL)
+
+async def _count_tickets(conn, where: str, values: tuple, sign: int, state: Optional[str] = None) -> None:
+    """
+    Adds (sign 1) or removes (sign -1) the tickets matching `where`, as they are now, to the
+    ticket_counts of their state, or of `state` if given.
+    A state change is counted by removing the ticket before it and adding it after it.
+    """
+    await conn.execute(
+        f"""
+        INSERT INTO bets4sats.ticket_counts (competition, wallet, state, tickets, amount, reward_msat)
+        SELECT competition, wallet, {"?" if state else "state"}, ? * COUNT(*), ? * SUM(amount), ? * SUM(reward_msat)
+        FROM bets4sats.tickets
+        WHERE {where}
+        GROUP BY competition, wallet, state
+        ON CONFLICT (competition, state) DO UPDATE SET
+            tickets = ticket_counts.tickets + excluded.tickets,
+            amount = ticket_counts.amount + excluded.amount,
+            reward_msat = ticket_counts.reward_msat + excluded.reward_msat
         """,
-        (ticket_id, wallet, competition, amount, reward_target, choice, "INITIAL", 0, "", ""),
+        (*((state,) if state else ()), sign, sign, sign, *values),
     )
 
-    # UPDATE COMPETITION DATA ON NEW TICKET
-    while True:
-      competitiondata = await get_competition(competition)
-      assert competitiondata, "Couldn't get competition from ticket being created"
-      if competitiondata.state != "INITIAL":
-          break
-      amount_tickets = competitiondata.amount_tickets - 1
-      update_result = await db.execute(
-          """
-          UPDATE bets4sats.competitions
-          SET amount_tickets = ?
-          WHERE id = ? AND amount_tickets = ? AND state = ?
-          """,
-          (amount_tickets, competition, competitiondata.amount_tickets, "INITIAL"),
-      )
-      if update_result.rowcount > 0:
-          break
+async def _record_ticket_deletions(conn, where: str, values: tuple) -> None:
+    """
+    Records the tickets matching `where`, about to be deleted, for the change feed of
+    get_wallet_competition_ticket_rows.
+    """
+    await conn.execute(
+        f"""
+        INSERT INTO bets4sats.ticket_deletions (ticket, competition, deleted)
+        SELECT id, competition, ? FROM bets4sats.tickets
+        WHERE {where}
+        """,
+        (int(time.time()), *values),
+    )
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="create_ticket")
+async def create_ticket(
+    ticket_id: str, wallet: str, competition: str, amount: int, reward_target: str,
+    choice: int, payment_hash: str, reward_target_status: str = "VALID",
+) -> Optional[Ticket]:
+    # None if the competition is closed or sold out
+    async with db.connect() as conn:
+        # Take the ticket from the competition first, so concurrent buyers can't oversell
+        # it and a competition completed elsewhere stops selling at once
+        result = await conn.execute(
+            """
+            UPDATE bets4sats.competitions
+            SET amount_tickets = amount_tickets - 1
+            WHERE id = ? AND state = ? AND amount_tickets > 0
+            """,
+            (competition, "INITIAL"),
+        )
+        if result.rowcount <= 0:
+            return None
+        await conn.execute(
+            """
+            INSERT INTO bets4sats.tickets (id, wallet, competition, amount, reward_target, choice, state, reward_msat, reward_failure, reward_payment_hash, payment_hash, updated, reward_target_status, reward_target_error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (ticket_id, wallet, competition, amount, reward_target, choice, "INITIAL", 0, "", "", payment_hash, int(time.time()), reward_target_status, ""),
+        )
+        await _count_tickets(conn, "id = ?", (ticket_id,), 1)
+    competition_cache.invalidate(competition)
 
     ticket = await get_ticket(ticket_id)
     assert ticket, "Newly created ticket couldn't be retrieved"
     return ticket
 
-async def purge_expired_tickets(competition_id: str) -> None:
-    purge_time = datetime.datetime.now() - datetime.timedelta(seconds=TICKET_PURGE_TIME)
-    delete_result = await db.execute(
-        """
-        DELETE FROM bets4sats.tickets
-        WHERE competition = ? AND state = ? AND time < """ + db.timestamp_placeholder,
-        (competition_id, "INITIAL", db.datetime_to_timestamp(purge_time))
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_next_ticket_purge_time")
+async def get_next_ticket_purge_time() -> Optional[int]:
+    row = await db.fetchone(
+        "SELECT MIN(time) AS time FROM bets4sats.tickets WHERE state = ?",
+        ("INITIAL",),
     )
-    if delete_result.rowcount <= 0:
-        return
-    while True:
-      competitiondata = await get_competition(competition_id)
-      assert competitiondata, "Couldn't get competition data for tickets being purged"
-      amount_tickets = competitiondata.amount_tickets + delete_result.rowcount
-      update_result = await db.execute(
-          """
-          UPDATE bets4sats.competitions
-          SET amount_tickets = ?
-          WHERE id = ? AND amount_tickets = ?
-          """,
-          (amount_tickets, competition_id, competitiondata.amount_tickets),
-      )
-      if update_result.rowcount > 0:
-          break
-
+    if not row or row["time"] is None:
+        return None
+    return row["time"] + TICKET_PURGE_TIME
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="purge_expired_tickets")
+async def purge_expired_tickets() -> int:
+    # On the same whole seconds clock as get_next_ticket_purge_time, so that every ticket
+    # past its purge time is purged, and purge_tickets_loop doesn't wake up for nothing
+    purge_time = datetime.datetime.fromtimestamp(int(time.time()) - TICKET_PURGE_TIME)
+    async with db.connect() as conn:
+        # Mark first, so tickets funded concurrently are neither released nor deleted
+        mark_result = await conn.execute(
+            """
+            UPDATE bets4sats.tickets
+            SET state = ?
+            WHERE state = ? AND time <= """ + db.timestamp_placeholder,
+            ("EXPIRED", "INITIAL", db.datetime_to_timestamp(purge_time))
+        )
+        if mark_result.rowcount <= 0:
+            return 0
+        competition_rows = await conn.fetchall(
+            "SELECT DISTINCT competition FROM bets4sats.tickets WHERE state = ?",
+            ("EXPIRED",),
+        )
+        await conn.execute(
+            """
+            UPDATE bets4sats.competitions
+            SET amount_tickets = amount_tickets + (
+                SELECT COUNT(*) FROM bets4sats.tickets
+                WHERE tickets.competition = competitions.id AND tickets.state = ?
+            )
+            WHERE id IN (SELECT competition FROM bets4sats.tickets WHERE state = ?)
+            """,
+            ("EXPIRED", "EXPIRED"),
+        )
+        await _count_tickets(conn, "state = ?", ("EXPIRED",), -1, state="INITIAL")
+        await _record_ticket_deletions(conn, "state = ?", ("EXPIRED",))
+        await conn.execute("DELETE FROM bets4sats.tickets WHERE state = ?", ("EXPIRED",))
+    for row in competition_rows:
+        competition_cache.invalidate(row["competition"])
+    return mark_result.rowcount
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="set_ticket_funded")
 async def set_ticket_funded(ticket_id: str) -> None:
-    cas_success = await cas_ticket_state(ticket_id, "INITIAL", "FUNDED")
-    if not cas_success:
-        return
     ticket = await get_ticket(ticket_id)
+    assert ticket, "Couldn't get ticket being paid"
+
+    # One transaction, locking the competition row after the ticket's: a concurrent
+    # complete_competition either settles this ticket as funded, or comes first and the
+    # ticket is refunded. It never misses it nor counts it in a pool it wasn't part of.
+    async with db.connect() as conn:
+        await _count_tickets(conn, "id = ?", (ticket_id,), -1)
+        cas_result = await conn.execute(
+            """
+            UPDATE bets4sats.tickets
+            SET state = ?, updated = ?
+            WHERE id = ? AND state = ?
+            """,
+            ("FUNDED", int(time.time()), ticket_id, "INITIAL"),
+        )
+        if cas_result.rowcount <= 0:
+            await _count_tickets(conn, "id = ?", (ticket_id,), 1)
+            return
 
-    # UPDATE COMPETITION DATA ON SOLD TICKET
-    while True:
-      competitiondata = await get_competition(ticket.competition)
-      assert competitiondata, "Couldn't get competition from ticket being paid"
-      if competitiondata.state != "INITIAL":
-          break
-      sold = competitiondata.sold + 1
-      choices = json.loads(competitiondata.choices)
-      choices[choice]["total"] += ticket.amount
-      update_result = await db.execute(
-          """
-          UPDATE bets4sats.competitions
-          SET sold = ?, choices = ?
-          WHERE id = ? AND sold = ? AND state = ?
-          """,
-          (sold, json.dumps(choices), ticket.competition, competitiondata.sold, "INITIAL"),
-      )
-      if update_result.rowcount > 0:
-          break
-
+        # UPDATE COMPETITION DATA ON SOLD TICKET
+        update_result = await conn.execute(
+            """
+            UPDATE bets4sats.competitions
+            SET sold = sold + 1
+            WHERE id = ? AND state = ?
+            """,
+            (ticket.competition, "INITIAL"),
+        )
+        if update_result.rowcount > 0:
+            await conn.execute(
+                """
+                UPDATE bets4sats.choices
+                SET total = total + ?, sold = sold + 1
+                WHERE competition = ? AND choice = ?
+                """,
+                (ticket.amount, ticket.competition, ticket.choice),
+            )
+        else:
+            # Paid after the competition was completed, so it is refunded
+            await conn.execute(
+                """
+                UPDATE bets4sats.tickets
+                SET state = ?, payout_msat = CAST(amount AS BIGINT) * 1000
+                WHERE id = ?
+                """,
+                ("CANCELLED_UNPAID", ticket_id),
+            )
+            await conn.execute(
+                "UPDATE bets4sats.competitions SET outstanding_payouts = outstanding_payouts + 1 WHERE id = ?",
+                (ticket.competition,),
+            )
+            await conn.execute(
+                """
+                INSERT INTO bets4sats.payouts (ticket, competition, claim, claimed_at, aggregate)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (ticket_id, ticket.competition, "", 0, False),
+            )
+        await _count_tickets(conn, "id = ?", (ticket_id,), 1)
+    competition_cache.invalidate(ticket.competition)
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="cas_ticket_state")
 async def cas_ticket_state(ticket_id: str, old_state: str, new_state: str) -> bool:
-    update_result = await db.execute(
-        """
-        UPDATE bets4sats.tickets
-        SET state = ?
-        WHERE id = ? AND state = ?
-        """,
-        (new_state, ticket_id, old_state)
-    )
+    async with db.connect() as conn:
+        await _count_tickets(conn, "id = ?", (ticket_id,), -1)
+        update_result = await conn.execute(
+            """
+            UPDATE bets4sats.tickets
+            SET state = ?, updated = ?
+            WHERE id = ? AND state = ?
+            """,
+            (new_state, int(time.time()), ticket_id, old_state)
+        )
+        await _count_tickets(conn, "id = ?", (ticket_id,), 1)
+    if update_result.rowcount <= 0:
+        metrics.inc("bets4sats_cas_failures_total", "State compare-and-swap updates that lost", table="tickets")
     return update_result.rowcount > 0
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="finish_ticket_payout")
+async def finish_ticket_payout(ticket_id: str, paying_state: str, new_state: str, **kwargs) -> bool:
+    """
+    Moves a ticket out of paying_state to a final state, updating the other fields given,
+    and counts it off its competition's outstanding payouts.
+    Returns False if the ticket was not in paying_state.
+    """
+    kwargs["state"] = new_state
+    kwargs["updated"] = int(time.time())
+    q = ", ".join([f"{field} = ?" for field in kwargs])
+    async with db.connect() as conn:
+        await _count_tickets(conn, "id = ?", (ticket_id,), -1)
+        update_result = await conn.execute(
+            f"UPDATE bets4sats.tickets SET {q} WHERE id = ? AND state = ?",
+            (*kwargs.values(), ticket_id, paying_state),
+        )
+        await _count_tickets(conn, "id = ?", (ticket_id,), 1)
+        if update_result.rowcount <= 0:
+            metrics.inc("bets4sats_cas_failures_total", "State compare-and-swap updates that lost", table="tickets")
+            return False
+        await conn.execute(
+            """
+            UPDATE bets4sats.competitions
+            SET outstanding_payouts = outstanding_payouts - 1
+            WHERE id = (SELECT competition FROM bets4sats.tickets WHERE id = ?)
+            """,
+            (ticket_id,),
+        )
+        row = await conn.fetchone("SELECT competition FROM bets4sats.tickets WHERE id = ?", (ticket_id,))
+    competition_cache.invalidate(row["competition"])
+    return True
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="update_ticket")
 async def update_ticket(ticket_id: str, **kwargs) -> Ticket:
+    kwargs["updated"] = int(time.time())
     q = ", ".join([f"{field[0]} = ?" for field in kwargs.items()])
-    await db.execute(
-        f"UPDATE bets4sats.tickets SET {q} WHERE id = ?", (*kwargs.values(), ticket_id)
-    )
+    async with db.connect() as conn:
+        counted = not kwargs.keys().isdisjoint(("state", "amount", "reward_msat"))
+        if counted:
+            await _count_tickets(conn, "id = ?", (ticket_id,), -1)
+        await conn.execute(
+            f"UPDATE bets4sats.tickets SET {q} WHERE id = ?", (*kwargs.values(), ticket_id)
+        )
+        if counted:
+            await _count_tickets(conn, "id = ?", (ticket_id,), 1)
     ticket = await get_ticket(ticket_id)
     assert ticket, "Newly updated ticket couldn't be retrieved"
     return ticket
 
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_ticket")
 async def get_ticket(ticket_id: str) -> Optional[Ticket]:
     row = await db.fetchone("SELECT * FROM bets4sats.tickets WHERE id = ?", (ticket_id,))
     return Ticket(**row) if row else None
 
 
-async def get_tickets(wallet_ids: Union[str, List[str]]) -> List[Ticket]:
+def _keyset_page(limit: Optional[int], after: Optional[Tuple[int, str]]) -> Tuple[str, str, tuple]:
+    # Rows are ordered by (time, id), and `after` is the (time, id) of the last row already seen.
+    # Compared as a row value, so the (wallet, time, id) index seeks straight to the page.
+    where = ""
+    values: tuple = ()
+    if after is not None:
+        after_time = db.datetime_to_timestamp(datetime.datetime.fromtimestamp(after[0]))
+        where = f" AND (time, id) > ({db.timestamp_placeholder}, ?)"
+        values = (after_time, after[1])
+    order = " ORDER BY time, id" + (f" LIMIT {int(limit)}" if limit is not None else "")
+    return where, order, values
+
+
+async def _get_wallets_page(
+    select: str, wallet_ids: List[str], limit: Optional[int], after: Optional[Tuple[int, str]]
+) -> list:
+    # A page of the rows of several wallets, each read in order from the (wallet, time, id)
+    # index and merged here, instead of all of them sorted by the database for every page
+    page_where, page_order, page_values = _keyset_page(limit, after)
+    wallet_rows = [
+        await db.fetchall(f"{select} WHERE wallet = ?{page_where}{page_order}", (wallet_id, *page_values))
+        for wallet_id in wallet_ids
+    ]
+    rows = heapq.merge(*wallet_rows, key=lambda row: (row["time"], row["id"]))
+    return list(itertools.islice(rows, limit))
+
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_ticket_rows")
+async def get_ticket_rows(
+    wallet_ids: Union[str, List[str]], limit: Optional[int] = None, after: Optional[Tuple[int, str]] = None
+) -> List[dict]:
+    # Plain rows, not Ticket models, as read-only lists are serialized straight to json
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
 
-    q = ",".join(["?"] * len(wallet_ids))
-    rows = await db.fetchall(
-        f"SELECT * FROM bets4sats.tickets WHERE wallet IN ({q})", (*wallet_ids,)
-    )
-    return [Ticket(**row) for row in rows]
+    rows = await _get_wallets_page("SELECT * FROM bets4sats.tickets", wallet_ids, limit, after)
+    return [dict(row) for row in rows]
 
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="delete_ticket")
 async def delete_ticket(ticket_id: str) -> None:
-    await db.execute("DELETE FROM bets4sats.tickets WHERE id = ?", (ticket_id,))
-
-
+    async with db.connect() as conn:
+        row = await conn.fetchone("SELECT competition, state FROM bets4sats.tickets WHERE id = ?", (ticket_id,))
+        await _count_tickets(conn, "id = ?", (ticket_id,), -1)
+        await _record_ticket_deletions(conn, "id = ?", (ticket_id,))
+        await conn.execute("DELETE FROM bets4sats.tickets WHERE id = ?", (ticket_id,))
+        await conn.execute("DELETE FROM bets4sats.payouts WHERE ticket = ?", (ticket_id,))
+        if row and row["state"] in OUTSTANDING_PAYOUT_STATES:
+            # Its payout will never finish, so it must not hold up the competition
+            await conn.execute(
+                "UPDATE bets4sats.competitions SET outstanding_payouts = outstanding_payouts - 1 WHERE id = ?",
+                (row["competition"],),
+            )
+    if row:
+        competition_cache.invalidate(row["competition"])
+
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="delete_competition_tickets")
 async def delete_competition_tickets(competition_id: str) -> None:
     await db.execute("DELETE FROM bets4sats.tickets WHERE competition = ?", (competition_id,))
+    await db.execute("DELETE FROM bets4sats.payouts WHERE competition = ?", (competition_id,))
+    await db.execute("DELETE FROM bets4sats.ticket_counts WHERE competition = ?", (competition_id,))
+    await db.execute("DELETE FROM bets4sats.ticket_deletions WHERE competition = ?", (competition_id,))
 
 
 # COMPETITIONS
 
 
+# Every column but banner, which is kept empty since banners moved to bets4sats.banners
+COMPETITION_COLUMNS = (
+    "id, wallet, register_id, name, info, banner_hash, closing_datetime, amount_tickets, min_bet, "
+    "max_bet, sold, choices, winning_choice, state, time, outstanding_payouts, settle_aggregate"
+)
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="create_competition")
 async def create_competition(data: CreateCompetition) -> Competition:
     competition_id = urlsafe_short_hash()
     register_id = shortuuid.random()
+    choices = [{ "title": choice["title"], "total": 0 } for choice in json.loads(data.choices)]
+    banner_hash = await create_banner(data.banner) if data.banner else ""
     await db.execute(
         """
-        INSERT INTO bets4sats.competitions (id, wallet, register_id, name, info, banner, closing_datetime, amount_tickets, min_bet, max_bet, sold, choices, winning_choice, state)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO bets4sats.competitions (id, wallet, register_id, name, info, banner, banner_hash, closing_datetime, amount_tickets, min_bet, max_bet, sold, choices, winning_choice, state)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
             competition_id,
@@ -160,23 +375,33 @@ async def create_competition(data: CreateCompetition) -> Competition:
             register_id,
             data.name,
             data.info,
-            data.banner,
+            "",
+            banner_hash,
             data.closing_datetime,
             data.amount_tickets,
             data.min_bet,
             data.max_bet,
             0,
-            json.dumps([{ "title": choice["title"], "total": 0 } for choice in json.loads(data.choices)]),
+            json.dumps(choices),
             -1,
             "INITIAL"
         ),
     )
+    for index in range(len(choices)):
+        await db.execute(
+            """
+            INSERT INTO bets4sats.choices (competition, choice, total, sold)
+            VALUES (?, ?, ?, ?)
+            """,
+            (competition_id, index, 0, 0),
+        )
 
     competition = await get_competition(competition_id)
     assert competition, "Newly created competition couldn't be retrieved"
     return competition
 
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="update_competition")
 async def update_competition(competition_id: str, data: UpdateCompetition) -> Optional[Competition]:
     query, values = zip(
         *([["amount_tickets = ?", data.amount_tickets]] if data.amount_tickets is not None else []),
@@ -189,11 +414,13 @@ async def update_competition(competition_id: str, data: UpdateCompetition) -> Op
         f"UPDATE bets4sats.competitions SET {', '.join(query)} WHERE id = ? AND state = ?",
         (*values, competition_id, "INITIAL"),
     )
+    competition_cache.invalidate(competition_id)
     if update_result.rowcount == 0:
         return None
     
     return await get_competition(competition_id)
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="cas_competition_state")
 async def cas_competition_state(competition_id: str, old_state: str, new_state: str) -> bool:
     update_result = await db.execute(
         """
@@ -203,8 +430,60 @@ async def cas_competition_state(competition_id: str, old_state: str, new_state:
         """,
         (new_state, competition_id, old_state)
     )
+    competition_cache.invalidate(competition_id)
+    if update_result.rowcount <= 0:
+        metrics.inc("bets4sats_cas_failures_total", "State compare-and-swap updates that lost", table="competitions")
+    return update_result.rowcount > 0
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="complete_competition")
+async def complete_competition(competition_id: str, winning_choice: int, aggregate: bool) -> bool:
+    """
+    Closes an INITIAL competition, storing how it is to be settled in the same write, so
+    that an interrupted settlement can be resumed.
+    """
+    update_result = await db.execute(
+        """
+        UPDATE bets4sats.competitions
+        SET state = ?, winning_choice = ?, settle_aggregate = ?
+        WHERE id = ? AND state = ?
+        """,
+        ("COMPLETED_PAYING", winning_choice, aggregate, competition_id, "INITIAL")
+    )
+    competition_cache.invalidate(competition_id)
+    if update_result.rowcount <= 0:
+        metrics.inc("bets4sats_cas_failures_total", "State compare-and-swap updates that lost", table="competitions")
     return update_result.rowcount > 0
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_unsettled_competitions")
+async def get_unsettled_competitions() -> List[Competition]:
+    # Completed competitions with tickets not settled or payouts not enqueued yet, or with
+    # nothing left to pay but not marked as paid. An aggregated payout is enqueued for one
+    # ticket of its reward target, and pays the others with the same outcome (won or
+    # cancelled) too; payouts of other outcomes, like late refunds, don't cover them.
+    rows = await db.fetchall(
+        f"""
+        SELECT {COMPETITION_COLUMNS} FROM bets4sats.competitions
+        WHERE state = ? AND (outstanding_payouts <= 0 OR EXISTS (
+            SELECT 1 FROM bets4sats.tickets
+            WHERE tickets.competition = competitions.id AND (
+                tickets.state = ? OR (
+                    (tickets.state = ? OR tickets.state = ?)
+                    AND NOT EXISTS (SELECT 1 FROM bets4sats.payouts WHERE payouts.ticket = tickets.id)
+                    AND NOT (competitions.settle_aggregate AND EXISTS (
+                        SELECT 1 FROM bets4sats.tickets AS siblings
+                        JOIN bets4sats.payouts ON payouts.ticket = siblings.id
+                        WHERE siblings.competition = tickets.competition AND siblings.reward_target = tickets.reward_target
+                        AND payouts.aggregate AND (siblings.state LIKE ?) = (tickets.state LIKE ?)
+                    ))
+                )
+            )
+        ))
+        """,
+        ("COMPLETED_PAYING", "FUNDED", "WON_UNPAID", "CANCELLED_UNPAID", "WON_%", "WON_%"),
+    )
+    return [Competition(**row) for row in rows]
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="set_winning_choice")
 async def set_winning_choice(competition_id: str, winning_choice: int) -> None:
     await db.execute(
         """
@@ -214,93 +493,270 @@ async def set_winning_choice(competition_id: str, winning_choice: int) -> None:
         """,
         (winning_choice, competition_id)
     )
+    competition_cache.invalidate(competition_id)
 
-async def sum_choices_amounts(competition_id: str) -> List[ChoiceAmountSum]:
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="sum_choices_amounts")
+async def sum_choices_amounts(competition_id: str, include_cancelled: bool = True) -> List[ChoiceAmountSum]:
+    # Only paid tickets are in the pool, not those still waiting for their invoice.
+    # Cancelled tickets of a competition with a winner were paid too late, and are refunded.
     choices = await db.fetchall(
-        """
+        f"""
         SELECT choice, SUM(amount) amount_sum
         FROM bets4sats.tickets
-        WHERE competition = ?
+        WHERE competition = ? AND state != ? AND state != ?{"" if include_cancelled else " AND state NOT LIKE ?"}
         GROUP BY choice
         """,
-        (competition_id,),        
+        (competition_id, "INITIAL", "EXPIRED", *(() if include_cancelled else ("CANCELLED_%",))),
     )
     return [ChoiceAmountSum(**choice) for choice in choices]
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="update_competition_winners")
 async def update_competition_winners(competition_id: str, choices: str, winning_choice: int):
-    await db.execute(
-        """
-        UPDATE bets4sats.competitions
-        SET choices = ?, winning_choice = ?
-        WHERE id = ?
-        """,
-        (choices, winning_choice, competition_id)
-    )
-    if winning_choice < 0:
-        await db.execute(
+    """
+    Moves the funded tickets of a completed competition to their outcome. Running it again,
+    to resume a settlement, only moves the tickets still funded.
+    """
+    now = int(time.time())
+    async with db.connect() as conn:
+        await conn.execute(
             """
-            UPDATE bets4sats.tickets
-            SET state = ?
-            WHERE competition = ? AND state = ?
+            UPDATE bets4sats.competitions
+            SET choices = ?, winning_choice = ?
+            WHERE id = ?
             """,
-            ("CANCELLED_UNPAID", competition_id, "FUNDED")
+            (choices, winning_choice, competition_id)
         )
-    else:
-        await db.execute(
+        for index, choice in enumerate(json.loads(choices)):
+            await conn.execute(
+                """
+                UPDATE bets4sats.choices
+                SET total = ?
+                WHERE competition = ? AND choice = ?
+                """,
+                (choice["total"], competition_id, index)
+            )
+        if winning_choice < 0:
+            await conn.execute(
+                """
+                UPDATE bets4sats.tickets
+                SET state = ?, updated = ?
+                WHERE competition = ? AND state = ?
+                """,
+                ("CANCELLED_UNPAID", now, competition_id, "FUNDED")
+            )
+        else:
+            await conn.execute(
+                """
+                UPDATE bets4sats.tickets
+                SET state = ?, updated = ?
+                WHERE competition = ? AND state = ? AND choice = ?
+                """,
+                ("WON_UNPAID", now, competition_id, "FUNDED", winning_choice)
+            )
+            await conn.execute(
+                """
+                UPDATE bets4sats.tickets
+                SET state = ?, updated = ?
+                WHERE competition = ? AND state = ? AND choice != ?
+                """,
+                ("LOST", now, competition_id, "FUNDED", winning_choice)
+            )
+        q = ",".join(["?"] * len(OUTSTANDING_PAYOUT_STATES))
+        await conn.execute(
+            f"""
+            UPDATE bets4sats.competitions
+            SET outstanding_payouts = (
+                SELECT COUNT(*) FROM bets4sats.tickets
+                WHERE competition = ? AND state IN ({q})
+            )
+            WHERE id = ?
+            """,
+            (competition_id, *OUTSTANDING_PAYOUT_STATES, competition_id)
+        )
+        # The bulk moves out of FUNDED above are counted by recounting the competition, once
+        await conn.execute("DELETE FROM bets4sats.ticket_counts WHERE competition = ?", (competition_id,))
+        await _count_tickets(conn, "competition = ?", (competition_id,), 1)
+    competition_cache.invalidate(competition_id)
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="set_ticket_payouts")
+async def set_ticket_payouts(competition_id: str, prize_pool_msat: int, winning_total: int) -> None:
+    """
+    Stores what each ticket of a completed competition is owed: its bet if cancelled, else
+    its share of prize_pool_msat if it won. Shares are rounded down, and the msats left over
+    go one each to the tickets with the largest remainders, then lowest ids, so the payouts
+    add up to the pool exactly whenever the winning tickets hold all of winning_total.
+    Deterministic, so running it again to resume a settlement doesn't change paid amounts.
+    """
+    now = int(time.time())
+    async with db.connect() as conn:
+        await conn.execute(
             """
             UPDATE bets4sats.tickets
-            SET state = ?
-            WHERE competition = ? AND state = ? AND choice = ?
+            SET payout_msat = CAST(amount AS BIGINT) * 1000, updated = ?
+            WHERE competition = ? AND state LIKE ?
             """,
-            ("WON_UNPAID", competition_id, "FUNDED", winning_choice)
+            (now, competition_id, "CANCELLED_%"),
         )
-        await db.execute(
+        if winning_total <= 0:
+            return
+        await conn.execute(
             """
             UPDATE bets4sats.tickets
-            SET state = ?
-            WHERE competition = ? AND state = ? AND choice != ?
+            SET payout_msat = CAST(amount AS BIGINT) * ? / ?, updated = ?
+            WHERE competition = ? AND state LIKE ?
+            """,
+            (prize_pool_msat, winning_total, now, competition_id, "WON_%"),
+        )
+        row = await conn.fetchone(
+            "SELECT COALESCE(SUM(payout_msat), 0) AS payouts_msat FROM bets4sats.tickets WHERE competition = ? AND state LIKE ?",
+            (competition_id, "WON_%"),
+        )
+        dust_msat = prize_pool_msat - row["payouts_msat"]
+        if dust_msat <= 0:
+            return
+        # x - x / y * y is the remainder, as the % operator isn't portable across drivers
+        await conn.execute(
+            f"""
+            UPDATE bets4sats.tickets
+            SET payout_msat = payout_msat + 1, updated = ?
+            WHERE id IN (
+                SELECT id FROM bets4sats.tickets
+                WHERE competition = ? AND state LIKE ?
+                ORDER BY CAST(amount AS BIGINT) * ? - CAST(amount AS BIGINT) * ? / ? * ? DESC, id
+                LIMIT {int(dust_msat)}
+            )
             """,
-            ("LOST", competition_id, "FUNDED", winning_choice)
+            (now, competition_id, "WON_%", prize_pool_msat, prize_pool_msat, winning_total, winning_total),
         )
 
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_choice_totals")
+async def get_choice_totals(competition_ids: List[str]) -> Dict[str, List[ChoiceTotal]]:
+    if not competition_ids:
+        return {}
+    q = ",".join(["?"] * len(competition_ids))
+    rows = await db.fetchall(
+        f"SELECT * FROM bets4sats.choices WHERE competition IN ({q})", (*competition_ids,)
+    )
+    choice_totals: Dict[str, List[ChoiceTotal]] = {}
+    for row in rows:
+        choice_total = ChoiceTotal(**row)
+        choice_totals.setdefault(choice_total.competition, []).append(choice_total)
+    return choice_totals
+
+
+def _with_choice_totals(row, choice_totals: List[ChoiceTotal]) -> dict:
+    # Pool totals live in bets4sats.choices, titles stay in the choices json
+    competition = dict(row)
+    # As the model has it, sqlite returns booleans as 0 and 1
+    competition["settle_aggregate"] = bool(competition["settle_aggregate"])
+    if choice_totals:
+        choices = json.loads(competition["choices"])
+        for choice_total in choice_totals:
+            choices[choice_total.choice]["total"] = choice_total.total
+            choices[choice_total.choice]["sold"] = choice_total.sold
+        competition["choices"] = json.dumps(choices)
+    return competition
+
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_competition")
 async def get_competition(competition_id: str) -> Optional[Competition]:
-    row = await db.fetchone("SELECT * FROM bets4sats.competitions WHERE id = ?", (competition_id,))
-    return Competition(**row) if row else None
+    competition = competition_cache.get(competition_id)
+    if competition:
+        return competition
+    # Taken before reading, so a write invalidating the entry meanwhile isn't undone
+    version = competition_cache.version()
+    row = await db.fetchone(f"SELECT {COMPETITION_COLUMNS} FROM bets4sats.competitions WHERE id = ?", (competition_id,))
+    if not row:
+        return None
+    choice_totals = await get_choice_totals([competition_id])
+    competition = Competition(**_with_choice_totals(row, choice_totals.get(competition_id, [])))
+    competition_cache.set(competition_id, competition, version=version)
+    return competition
 
 
-async def get_competitions(wallet_ids: Union[str, List[str]]) -> List[Competition]:
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_competition_rows")
+async def get_competition_rows(
+    wallet_ids: Union[str, List[str]], limit: Optional[int] = None, after: Optional[Tuple[int, str]] = None
+) -> List[dict]:
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
 
-    q = ",".join(["?"] * len(wallet_ids))
-    rows = await db.fetchall(
-        f"SELECT * FROM bets4sats.competitions WHERE wallet IN ({q})", (*wallet_ids,)
-    )
+    rows = await _get_wallets_page(f"SELECT {COMPETITION_COLUMNS} FROM bets4sats.competitions", wallet_ids, limit, after)
+    choice_totals = await get_choice_totals([row["id"] for row in rows])
 
-    return [Competition(**row) for row in rows]
+    return [_with_choice_totals(row, choice_totals.get(row["id"], [])) for row in rows]
 
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_all_competitions")
 async def get_all_competitions() -> List[Competition]:
     rows = await db.fetchall(
-        f"SELECT * FROM bets4sats.competitions",
+        f"SELECT {COMPETITION_COLUMNS} FROM bets4sats.competitions",
     )
-    return [Competition(**row) for row in rows]
+    choice_totals = await get_choice_totals([row["id"] for row in rows])
+    return [Competition(**_with_choice_totals(row, choice_totals.get(row["id"], []))) for row in rows]
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="delete_competition")
 async def delete_competition(competition_id: str) -> None:
+    row = await db.fetchone("SELECT banner_hash FROM bets4sats.competitions WHERE id = ?", (competition_id,))
     await db.execute("DELETE FROM bets4sats.competitions WHERE id = ?", (competition_id,))
+    await db.execute("DELETE FROM bets4sats.choices WHERE competition = ?", (competition_id,))
+    competition_cache.invalidate(competition_id)
+    if row and row["banner_hash"]:
+        # Banners are shared by the competitions using the same one
+        await db.execute(
+            """
+            DELETE FROM bets4sats.banners
+            WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM bets4sats.competitions WHERE banner_hash = ?)
+            """,
+            (row["banner_hash"], row["banner_hash"]),
+        )
+
+
+# BANNERS (stored once per content, by sha256)
+
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="create_banner")
+async def create_banner(banner: str) -> str:
+    banner_hash = hashlib.sha256(banner.encode()).hexdigest()
+    await db.execute(
+        "INSERT INTO bets4sats.banners (hash, banner) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING",
+        (banner_hash, banner),
+    )
+    return banner_hash
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_banner")
+async def get_banner(banner_hash: str) -> Optional[str]:
+    row = await db.fetchone("SELECT banner FROM bets4sats.banners WHERE hash = ?", (banner_hash,))
+    return row["banner"] if row else None
 
 
 # COMPETITIONTICKETS
 
 
-async def get_wallet_competition_tickets(competition_id: str) -> List[Ticket]:
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_wallet_competition_ticket_rows")
+async def get_wallet_competition_ticket_rows(competition_id: str, since: Optional[int] = None) -> List[dict]:
+    if since is not None:
+        # Tickets created or changed at or after `since` (epoch seconds), then those deleted
+        # since, as {"id", "updated", "deleted": True} for the clients to drop them
+        rows = await db.fetchall(
+            "SELECT * FROM bets4sats.tickets WHERE competition = ? AND updated >= ?",
+            (competition_id, since),
+        )
+        deletions = await db.fetchall(
+            "SELECT ticket, deleted FROM bets4sats.ticket_deletions WHERE competition = ? AND deleted >= ?",
+            (competition_id, since),
+        )
+        return [dict(row) for row in rows] + [
+            {"id": row["ticket"], "updated": row["deleted"], "deleted": True} for row in deletions
+        ]
     rows = await db.fetchall(
         "SELECT * FROM bets4sats.tickets WHERE competition = ?",
         (competition_id,),
     )
-    return [Ticket(**row) for row in rows]
+    return [dict(row) for row in rows]
 
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_state_competition_tickets")
 async def get_state_competition_tickets(competition_id: str, states: List[str]) -> List[Ticket]:
     assert len(states) > 0, "get_state_competition_tickets called with no states"
     query = " OR ".join(["state = ?" for _state in states])
@@ -310,9 +766,156 @@ async def get_state_competition_tickets(competition_id: str, states: List[str])
     )
     return [Ticket(**row) for row in rows]
 
-async def is_competition_payment_complete(competition_id: str) -> List[Ticket]:
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_reward_target_tickets")
+async def get_reward_target_tickets(competition_id: str, reward_target: str, states: List[str]) -> List[Ticket]:
+    assert len(states) > 0, "get_reward_target_tickets called with no states"
+    query = " OR ".join(["state = ?" for _state in states])
+    rows = await db.fetchall(
+        f"SELECT * FROM bets4sats.tickets WHERE competition = ? AND reward_target = ? AND ({query})",
+        (competition_id, reward_target, *states),
+    )
+    return [Ticket(**row) for row in rows]
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="is_competition_payment_complete")
+async def is_competition_payment_complete(competition_id: str) -> bool:
+    # Not from the cache, as other processes may have finished the last payouts
     row = await db.fetchone(
-        "SELECT id FROM bets4sats.tickets WHERE competition = ? AND state != ? AND state != ? AND state != ? AND state != ? AND state != ? LIMIT 1",
-        (competition_id, "CANCELLED_PAID", "CANCELLED_PAYMENT_FAILED", "WON_PAID", "WON_PAYMENT_FAILED", "LOST"),
+        "SELECT outstanding_payouts FROM bets4sats.competitions WHERE id = ?",
+        (competition_id,),
+    )
+    return bool(row) and row["outstanding_payouts"] <= 0
+
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="get_ticket_counts")
+async def get_ticket_counts(wallet_ids: Union[str, List[str]]) -> List[TicketCount]:
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return []
+
+    q = ",".join(["?"] * len(wallet_ids))
+    rows = await db.fetchall(
+        f"SELECT * FROM bets4sats.ticket_counts WHERE wallet IN ({q}) AND tickets != 0",
+        (*wallet_ids,),
+    )
+    return [TicketCount(**row) for row in rows]
+
+
+# PAYOUTS (outbox of tickets waiting to be rewarded or refunded)
+
+PAYOUT_CLAIM_TIMEOUT = 10 * 60 # a claim not finished by then is taken over by another worker
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="enqueue_competition_payouts")
+async def enqueue_competition_payouts(
+    competition_id: str, aggregate: bool = False, after: Optional[str] = None, limit: int = 1000
+) -> Tuple[int, Optional[str]]:
+    """
+    Adds the payouts of the next `limit` unpaid tickets, or reward targets if aggregate,
+    after the `after` key (from the first if None) to the outbox, skipping those already in it.
+    Returns the number of payouts added and the key to continue from, None when done.
+    """
+    # Aggregate payouts are one per reward target, paying all its tickets together
+    key = "reward_target" if aggregate else "id"
+    # Not compared to "" for the first chunk, which is a valid (empty) reward target
+    after_where = "" if after is None else f" AND {key} > ?"
+    after_values = () if after is None else (after,)
+    keys = await db.fetchall(
+        f"""
+        SELECT DISTINCT {key} AS key
+        FROM bets4sats.tickets
+        WHERE competition = ? AND (state = ? OR state = ?){after_where}
+        ORDER BY {key}
+        LIMIT {int(limit)}
+        """,
+        (competition_id, "WON_UNPAID", "CANCELLED_UNPAID", *after_values),
+    )
+    if not keys:
+        return 0, None
+    last = keys[-1]["key"]
+    # An aggregate payout is one per reward target and outcome: a late refund enqueued on its
+    # own doesn't pay the winnings of its reward target, nor the other way around
+    aggregate_where = """
+        AND NOT EXISTS (
+            SELECT 1 FROM bets4sats.tickets AS siblings
+            JOIN bets4sats.payouts ON payouts.ticket = siblings.id
+            WHERE siblings.competition = tickets.competition AND siblings.reward_target = tickets.reward_target
+            AND payouts.aggregate AND (siblings.state LIKE ?) = (tickets.state LIKE ?)
+        )
+    """ if aggregate else ""
+    aggregate_values = ("WON_%", "WON_%") if aggregate else ()
+    insert_result = await db.execute(
+        f"""
+        INSERT INTO bets4sats.payouts (ticket, competition, claim, claimed_at, aggregate)
+        SELECT {"MIN(id)" if aggregate else "id"}, competition, ?, ?, ?
+        FROM bets4sats.tickets
+        WHERE competition = ? AND (state = ? OR state = ?){after_where} AND {key} <= ?
+        AND NOT EXISTS (SELECT 1 FROM bets4sats.payouts WHERE payouts.ticket = tickets.id)
+        {aggregate_where}
+        {"GROUP BY competition, reward_target, state" if aggregate else ""}
+        """,
+        ("", 0, aggregate, competition_id, "WON_UNPAID", "CANCELLED_UNPAID", *after_values, last, *aggregate_values),
     )
-    return not row
+    return insert_result.rowcount, last
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="count_competition_payouts_to_enqueue")
+async def count_competition_payouts_to_enqueue(competition_id: str, aggregate: bool = False) -> int:
+    row = await db.fetchone(
+        f"""
+        SELECT {"COUNT(DISTINCT reward_target)" if aggregate else "COUNT(*)"} AS count
+        FROM bets4sats.tickets
+        WHERE competition = ? AND (state = ? OR state = ?)
+        """,
+        (competition_id, "WON_UNPAID", "CANCELLED_UNPAID"),
+    )
+    return row["count"]
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="claim_payouts")
+async def claim_payouts(limit: int) -> List[Payout]:
+    claim = urlsafe_short_hash()
+    now = int(time.time())
+    expired = now - PAYOUT_CLAIM_TIMEOUT
+    # claimed_at is re-checked on the outer statement, so concurrent claimers never share a row
+    await db.execute(
+        f"""
+        UPDATE bets4sats.payouts
+        SET claim = ?, claimed_at = ?
+        WHERE claimed_at < ? AND ticket IN (
+            SELECT ticket FROM bets4sats.payouts
+            WHERE claimed_at < ?
+            ORDER BY claimed_at
+            LIMIT {int(limit)}
+        )
+        """,
+        (claim, now, expired, expired),
+    )
+    rows = await db.fetchall(
+        "SELECT * FROM bets4sats.payouts WHERE claim = ?",
+        (claim,),
+    )
+    return [Payout(**row) for row in rows]
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="refresh_payout_claim")
+async def refresh_payout_claim(ticket_id: str, claim: str) -> bool:
+    # Keeps the claim of a payout still running from timing out, False if it was lost
+    update_result = await db.execute(
+        "UPDATE bets4sats.payouts SET claimed_at = ? WHERE ticket = ? AND claim = ?",
+        (int(time.time()), ticket_id, claim),
+    )
+    return update_result.rowcount > 0
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="release_payout_claims")
+async def release_payout_claims() -> int:
+    update_result = await db.execute(
+        "UPDATE bets4sats.payouts SET claim = ?, claimed_at = ? WHERE claimed_at > ?",
+        ("", 0, 0),
+    )
+    return update_result.rowcount
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="delete_payout")
+async def delete_payout(ticket_id: str) -> None:
+    await db.execute("DELETE FROM bets4sats.payouts WHERE ticket = ?", (ticket_id,))
+
+@metrics.timed(CRUD_SECONDS, CRUD_SECONDS_HELP, function="count_payouts")
+async def count_payouts() -> int:
+    row = await db.fetchone("SELECT COUNT(*) AS count FROM bets4sats.payouts")
+    return row["count"] if row else 0
@@ -1,51 +1,218 @@
-from typing import Dict, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
 from datetime import datetime
 from http import HTTPStatus
-from urllib.parse import urlparse, quote
+import asyncio
+import base64
+import binascii
+from urllib.parse import urlparse, quote, unquote_to_bytes
 import json
 import re
 
 from lnbits import lnurl, bolt11
 from lnbits.core.services import fee_reserve, pay_invoice, create_invoice
-from lnbits.core.crud import get_payments, get_wallet
-from lnbits.core.models import PaymentFilters
-from lnbits.db import Filters, Filter
+from lnbits.core.crud import get_standalone_payment, get_wallet
 from starlette.exceptions import HTTPException
 import httpx
 from loguru import logger
 
-from .crud import get_competition, get_ticket, set_ticket_funded
+from . import metrics
+from .cache import LruTtlCache
+from .crud import get_competition, get_ticket, set_ticket_funded, update_ticket
 from .models import LnurlpParameters
 
-# Similar to /api/v1/lnurlscan/{code}
-async def get_lnurlp_parameters(code: str) -> LnurlpParameters | str:
+try:
+    import h2  # noqa: F401 - httpx needs it for http/2
+    LNURL_HTTP2 = True
+except ImportError:
+    LNURL_HTTP2 = False
+
+LNURL_TIMEOUT = httpx.Timeout(5.0)
+LNURL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+LNURL_HOST_CONNECTIONS = 10 # httpx has no per-host pool limit, so it is enforced in http_get
+
+class HostSlots:
+    """
+    A semaphore per host, dropped when no one holds or waits for it anymore, so that
+    hosts seen once don't stay in memory.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self._users: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def use(self, host: str) -> AsyncIterator[asyncio.Semaphore]:
+        # The host's semaphore, which the caller acquires and releases within the block
+        slots = self._slots.setdefault(host, asyncio.Semaphore(self.limit))
+        self._users[host] = self._users.get(host, 0) + 1
+        try:
+            yield slots
+        finally:
+            self._users[host] -= 1
+            if not self._users[host]:
+                del self._users[host]
+                del self._slots[host]
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+# Shared by all outbound lnurl traffic, so payouts reuse connections instead of
+# doing a new TCP/TLS handshake per request
+http_client: Optional[httpx.AsyncClient] = None
+http_host_slots = HostSlots(LNURL_HOST_CONNECTIONS)
+
+def start_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(timeout=LNURL_TIMEOUT, limits=LNURL_LIMITS, http2=LNURL_HTTP2)
+    return http_client
+
+async def close_http_client() -> None:
+    global http_client
+    client, http_client = http_client, None
+    if client is not None:
+        await client.aclose()
+
+async def http_get(url: str) -> httpx.Response:
+    client = start_http_client()
+    host = urlparse(url).netloc.lower()
+    async with http_host_slots.use(host) as slots:
+        async with slots:
+            return await client.get(url)
+
+# Banners are served from the lnbits origin, so only types that can't run scripts
+BANNER_MEDIA_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+
+def parse_banner_data_url(banner: str) -> Optional[Tuple[str, bytes]]:
+    """
+    Media type and content of a data: url banner, or None if it isn't a valid data: url of
+    an allowed image type.
+    """
+    if not banner.startswith("data:"):
+        return None
+    # data:[<media type>][;base64],<data>
+    header, _, data = banner[len("data:"):].partition(",")
+    media_type, *parameters = header.split(";")
+    media_type = media_type.strip().lower()
+    if media_type not in BANNER_MEDIA_TYPES:
+        return None
     try:
-        url = lnurl.decode(code)
+        body = base64.b64decode(data, validate=True) if "base64" in parameters else unquote_to_bytes(data)
+    except binascii.Error:
+        return None
+    return media_type, body
+
+def is_banner_valid(banner: str) -> bool:
+    return banner == "" or banner.startswith(("https://", "http://")) or parse_banner_data_url(banner) is not None
+
+def get_lnurlp_url(code: str) -> Optional[str]:
+    """
+    Url of the lnurl-pay parameters of an lnurl-pay or a lightning-address, or None if
+    the code is neither (it might still be a wallet-id).
+    """
+    try:
+        return lnurl.decode(code)
     except:
         name_domain = code.split("@")
         if len(name_domain) == 2 and len(name_domain[1].split(".")) >= 2:
             name, domain = name_domain
-            url = (
+            return (
                 ("http://" if domain.endswith(".onion") else "https://")
                 + domain
                 + "/.well-known/lnurlp/"
                 + name
             )
-        else:
-            reward_wallet = await get_wallet(code)
-            if reward_wallet is not None:
-                return code
-            raise Exception("Malformed lnurl-pay, lightning-address or wallet-id")
+        return None
+
+def get_reward_host(code: str) -> str:
+    # Empty for rewards paid to local wallets
+    url = get_lnurlp_url(code)
+    if url is None:
+        return ""
+    try:
+        return urlparse(url).netloc.lower()
+    except:
+        return ""
+
+def is_reward_target_well_formed(code: str) -> bool:
+    # Cheap syntactic check: an lnurl-pay, a lightning-address or a wallet-id (uuid hex)
+    return get_lnurlp_url(code) is not None or re.match(r"^[0-9a-f]{32}$", code) is not None
+
+async def verify_ticket_reward_target(ticket_id: str, reward_target: str) -> None:
+    try:
+        await get_lnurlp_parameters(reward_target)
+    except Exception as error:
+        logger.warning(f"verify_ticket_reward_target: failed: {ticket_id} {error}")
+        status, reward_target_error = "INVALID", str(error)
+    else:
+        status, reward_target_error = "VALID", ""
+    try:
+        await update_ticket(ticket_id, reward_target_status=status, reward_target_error=reward_target_error)
+    except AssertionError:
+        logger.info(f"verify_ticket_reward_target: ticket purged before verified: {ticket_id}")
+
+LNURLP_CACHE_SIZE = 10_000
+LNURLP_CACHE_TTL = 5 * 60
+LNURLP_CACHE_ERROR_TTL = 30
+
+lnurlp_cache: LruTtlCache[Union[LnurlpParameters, str, Exception]] = LruTtlCache(
+    LNURLP_CACHE_SIZE, LNURLP_CACHE_TTL
+)
+# Lookups in progress, so concurrent requests for the same target share one fetch
+lnurlp_lookups: Dict[str, asyncio.Task] = {}
+
+def normalize_reward_target(code: str) -> str:
+    code = code.strip()
+    # lnurls (bech32) and lightning-addresses are case insensitive, wallet-ids are not
+    if "@" in code or code.lower().startswith("lnurl"):
+        return code.lower()
+    return code
+
+async def get_lnurlp_parameters(code: str) -> LnurlpParameters | str:
+    key = normalize_reward_target(code)
+    cached = lnurlp_cache.get(key)
+    if isinstance(cached, Exception):
+        raise Exception(str(cached))
+    if cached is not None:
+        return cached
+    lookup = lnurlp_lookups.get(key)
+    if lookup is None:
+        lookup = asyncio.create_task(resolve_lnurlp_parameters(key, code))
+        lnurlp_lookups[key] = lookup
+    # shield, so a cancelled request doesn't cancel the lookup shared with others
+    return await asyncio.shield(lookup)
+
+async def resolve_lnurlp_parameters(key: str, code: str) -> LnurlpParameters | str:
+    try:
+        params = await fetch_lnurlp_parameters(code)
+    except Exception as exception:
+        lnurlp_cache.set(key, exception, LNURLP_CACHE_ERROR_TTL)
+        raise
+    else:
+        lnurlp_cache.set(key, params)
+        return params
+    finally:
+        lnurlp_lookups.pop(key, None)
+
+# Similar to /api/v1/lnurlscan/{code}
+async def fetch_lnurlp_parameters(code: str) -> LnurlpParameters | str:
+    url = get_lnurlp_url(code)
+    if url is None:
+        reward_wallet = await get_wallet(code)
+        if reward_wallet is not None:
+            return code
+        raise Exception("Malformed lnurl-pay, lightning-address or wallet-id")
     try:
         parsed_url = urlparse(url)
     except:
         raise Exception("Unparsable lnurl-pay or lightning-address")
     if "tag=login" in parsed_url.query.split("&"):
         raise Exception("Invalid lnurl-pay - this is an lnurl-auth")
-    async with httpx.AsyncClient() as client:
-        r = await client.get(url, timeout=5)
-        if r.is_error:
-            raise Exception("Failed to get lnurl-pay parameters")
+    r = await http_get(url)
+    if r.is_error:
+        raise Exception("Failed to get lnurl-pay parameters")
     try:
         data = json.loads(r.text)
     except json.decoder.JSONDecodeError:
@@ -72,6 +239,7 @@ async def get_lnurlp_parameters(code: str) -> LnurlpParameters | str:
         commentAllowed=commentAllowed if isinstance(commentAllowed, int) else 0,
     )
 
+@metrics.timed("bets4sats_pay_lnurlp_seconds", "Latency of reward payments, including lnurl calls")
 async def pay_lnurlp(wallet_id: str, code: str, amount_msat: int, description: str, extra: Optional[Dict]) -> tuple[str, int]:
     # Deduct lightning fees
     # This may actually deduct too much, because the final fee will be
@@ -96,10 +264,9 @@ async def pay_lnurlp(wallet_id: str, code: str, amount_msat: int, description: s
         full_callback_url = params.callback + ("&" if parsed_callback.query else "?") + f"amount={final_amount_msat}" + (
             f"&comment={quote(comment)}" if comment else ""
         )
-        async with httpx.AsyncClient() as client:
-            r = await client.get(full_callback_url, timeout=5)
-            if r.is_error:
-                raise Exception("Failed to call callback url")
+        r = await http_get(full_callback_url)
+        if r.is_error:
+            raise Exception("Failed to call callback url")
         try:
             data = json.loads(r.text)
         except json.decoder.JSONDecodeError:
@@ -156,32 +323,21 @@ async def send_ticket(competition_id, ticket_id):
             detail="Competition could not be fetched.",
         )
     ticket = await get_ticket(ticket_id)
-    if not ticket or ticket.competition_id != competition_id:
+    if not ticket or ticket.competition != competition_id:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail="Ticket could not be fetched, or invoice has expired.",
         )
-    # TODO: Save payment-hash on ticket, so we could use get_standalone_payment()
-    # instead of get_payments()
-    all_payments = await get_payments(
-        wallet_id=competition.wallet,
-        incoming=True,
-        limit=1,
-        filters=Filters(
-            filters=[Filter(
-              field="memo",
-              values=[f"Bets4SatsTicketId:{competition_id}.{ticket_id}"],
-              model=PaymentFilters
-            )],
-            model=PaymentFilters,
-        )
+    if ticket.state != "INITIAL":
+        return {"paid": True}
+    payment = await get_standalone_payment(
+        ticket.payment_hash, incoming=True, wallet_id=competition.wallet
     )
-    if not all_payments:
+    if not payment:
         raise HTTPException(
               status_code=HTTPStatus.NOT_FOUND,
               detail="Ticket payment could not be fetched, or invoice has expired.",
           )
-    payment, = all_payments
     if payment.pending:
         await payment.check_status()
     paid = not payment.pending
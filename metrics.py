@@ -0,0 +1,86 @@
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, List, Tuple
+import time
+
+# Upper bounds in seconds, as in the prometheus client defaults plus slow lnurl calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+counters: Dict[str, Dict[Labels, float]] = {}
+# name -> labels -> [bucket counts..., +Inf count, sum]
+histograms: Dict[str, Dict[Labels, List[float]]] = {}
+help_texts: Dict[str, str] = {}
+
+
+def inc(name: str, help_text: str, value: float = 1, **labels: str) -> None:
+    help_texts.setdefault(name, help_text)
+    series = counters.setdefault(name, {})
+    key = tuple(sorted(labels.items()))
+    series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, help_text: str, seconds: float, **labels: str) -> None:
+    help_texts.setdefault(name, help_text)
+    series = histograms.setdefault(name, {})
+    key = tuple(sorted(labels.items()))
+    values = series.get(key)
+    if values is None:
+        values = series[key] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+    values[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    values[-1] += seconds
+
+
+def timed(name: str, help_text: str, **labels: str):
+    """
+    Decorator recording the latency of an async function in a histogram, and its
+    exceptions in a <name>_errors_total counter.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                inc(f"{name}_errors_total", f"Exceptions raised, see {name}", **labels)
+                raise
+            finally:
+                observe(name, help_text, time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = [(key, value.replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def render_prometheus(gauges: Dict[str, Tuple[str, float]]) -> str:
+    """
+    All metrics in the prometheus text exposition format, with `gauges` (name -> help
+    text, value) sampled by the caller.
+    """
+    lines = []
+    for name, (help_text, value) in gauges.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, series in counters.items():
+        lines += [f"# HELP {name} {help_texts[name]}", f"# TYPE {name} counter"]
+        lines += [f"{name}{format_labels(labels)} {value}" for labels, value in series.items()]
+    for name, series in histograms.items():
+        lines += [f"# HELP {name} {help_texts[name]}", f"# TYPE {name} histogram"]
+        for labels, values in series.items():
+            cumulative = 0.0
+            for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), values[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
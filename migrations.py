@@ -1,3 +1,11 @@
+import hashlib
+import json
+
+from lnbits.core.crud import get_payments
+from lnbits.core.models import PaymentFilters
+from lnbits.db import SQLITE, Filters, Filter
+
+
 async def m001_initial(db):
     await db.execute(
         """
@@ -44,3 +52,380 @@ async def m002_changed(db):
         );
     """
     )
+
+
+async def m003_choices(db):
+    """
+    Move per-choice pool totals out of the competitions.choices json, so they can be
+    updated with relative statements instead of rewriting the competition row.
+    """
+    await db.execute(
+        """
+        CREATE TABLE bets4sats.choices (
+            competition TEXT NOT NULL,
+            choice INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            sold INTEGER NOT NULL,
+            PRIMARY KEY (competition, choice)
+        );
+    """
+    )
+    competitions = await db.fetchall("SELECT id, choices FROM bets4sats.competitions")
+    for competition in competitions:
+        # Backfilled from the funded tickets like sold, the json total can be stale
+        # if concurrent fundings overwrote each other's rewrite of the choices
+        funded_rows = await db.fetchall(
+            """
+            SELECT choice, COUNT(*) sold, SUM(amount) total
+            FROM bets4sats.tickets
+            WHERE competition = ? AND state != ?
+            GROUP BY choice
+            """,
+            (competition["id"], "INITIAL"),
+        )
+        funded = {row["choice"]: row for row in funded_rows}
+        for index, _ in enumerate(json.loads(competition["choices"])):
+            row = funded.get(index)
+            await db.execute(
+                """
+                INSERT INTO bets4sats.choices (competition, choice, total, sold)
+                VALUES (?, ?, ?, ?)
+                """,
+                (competition["id"], index, row["total"] if row else 0, row["sold"] if row else 0),
+            )
+
+
+async def m004_indexes(db):
+    """
+    Indexes for the wallet lookups of the admin page, and for the per-competition
+    state/time lookups of the ticket purge, payout and registration paths.
+    """
+    indexes = [
+        ("competitions_wallet", "competitions", "wallet"),
+        ("tickets_wallet", "tickets", "wallet"),
+        ("tickets_competition_state_time", "tickets", "competition, state, time"),
+    ]
+    for index_name, table, columns in indexes:
+        if db.type == SQLITE:
+            # sqlite puts the schema on the index name, and the table must be in the same schema
+            await db.execute(f"CREATE INDEX bets4sats.{index_name} ON {table} ({columns});")
+        else:
+            await db.execute(f"CREATE INDEX {index_name} ON bets4sats.{table} ({columns});")
+
+
+async def m005_ticket_payment_hash(db):
+    """
+    Store the invoice payment_hash on tickets, so the payment can be looked up directly
+    instead of searching the competition wallet by memo.
+    """
+    await db.execute(
+        "ALTER TABLE bets4sats.tickets ADD COLUMN payment_hash TEXT NOT NULL DEFAULT '';"
+    )
+    # Only unfunded tickets still need their payment checked, older ones are purged anyway
+    tickets = await db.fetchall(
+        "SELECT id, wallet, competition FROM bets4sats.tickets WHERE state = ?",
+        ("INITIAL",),
+    )
+    for ticket in tickets:
+        payments = await get_payments(
+            wallet_id=ticket["wallet"],
+            incoming=True,
+            limit=1,
+            filters=Filters(
+                filters=[Filter(
+                  field="memo",
+                  values=[f"Bets4SatsTicketId:{ticket['competition']}.{ticket['id']}"],
+                  model=PaymentFilters
+                )],
+                model=PaymentFilters,
+            )
+        )
+        if payments:
+            await db.execute(
+                "UPDATE bets4sats.tickets SET payment_hash = ? WHERE id = ?",
+                (payments[0].payment_hash, ticket["id"]),
+            )
+
+
+async def m006_tickets_state_time_index(db):
+    """
+    Index for finding the earliest unfunded ticket across all competitions.
+    """
+    if db.type == SQLITE:
+        await db.execute("CREATE INDEX bets4sats.tickets_state_time ON tickets (state, time);")
+    else:
+        await db.execute("CREATE INDEX tickets_state_time ON bets4sats.tickets (state, time);")
+
+
+async def m007_wallet_time_indexes(db):
+    """
+    Replace the wallet indexes with (wallet, time, id), matching the keyset pagination
+    order of the ticket and competition lists.
+    """
+    for table in ["competitions", "tickets"]:
+        if db.type == SQLITE:
+            await db.execute(f"DROP INDEX bets4sats.{table}_wallet;")
+            await db.execute(
+                f"CREATE INDEX bets4sats.{table}_wallet_time_id ON {table} (wallet, time, id);"
+            )
+        else:
+            await db.execute(f"DROP INDEX bets4sats.{table}_wallet;")
+            await db.execute(
+                f"CREATE INDEX {table}_wallet_time_id ON bets4sats.{table} (wallet, time, id);"
+            )
+
+
+async def m008_tickets_updated(db):
+    """
+    Track when each ticket was last created or changed (epoch seconds), so the
+    registration page can fetch only what changed since its last sync.
+    """
+    await db.execute(
+        "ALTER TABLE bets4sats.tickets ADD COLUMN updated INTEGER NOT NULL DEFAULT 0;"
+    )
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX bets4sats.tickets_competition_updated ON tickets (competition, updated);"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX tickets_competition_updated ON bets4sats.tickets (competition, updated);"
+        )
+
+
+async def m009_payouts(db):
+    """
+    Durable outbox of tickets waiting to be rewarded or refunded, so payouts survive
+    restarts. Rows are deleted once handled.
+    """
+    await db.execute(
+        """
+        CREATE TABLE bets4sats.payouts (
+            ticket TEXT PRIMARY KEY,
+            competition TEXT NOT NULL,
+            claim TEXT NOT NULL,
+            claimed_at INTEGER NOT NULL,
+            time TIMESTAMP NOT NULL DEFAULT """
+        + db.timestamp_now
+        + """
+        );
+    """
+    )
+    if db.type == SQLITE:
+        await db.execute("CREATE INDEX bets4sats.payouts_claimed_at ON payouts (claimed_at);")
+        await db.execute("CREATE INDEX bets4sats.payouts_claim ON payouts (claim);")
+    else:
+        await db.execute("CREATE INDEX payouts_claimed_at ON bets4sats.payouts (claimed_at);")
+        await db.execute("CREATE INDEX payouts_claim ON bets4sats.payouts (claim);")
+    # Resume the payouts of competitions that were being paid before this migration
+    await db.execute(
+        """
+        INSERT INTO bets4sats.payouts (ticket, competition, claim, claimed_at)
+        SELECT id, competition, ?, ?
+        FROM bets4sats.tickets
+        WHERE state IN (?, ?, ?, ?)
+        """,
+        ("", 0, "WON_UNPAID", "CANCELLED_UNPAID", "WON_PAYING", "CANCELLED_PAYING"),
+    )
+
+
+async def m010_payouts_aggregate(db):
+    """
+    Payouts that pay all the tickets of their reward target in one payment.
+    """
+    await db.execute(
+        "ALTER TABLE bets4sats.payouts ADD COLUMN aggregate BOOLEAN NOT NULL DEFAULT false;"
+    )
+
+
+async def m011_tickets_reward_target_status(db):
+    """
+    Result of verifying the reward target, which may now happen after the ticket is created.
+    Existing tickets were verified before creation.
+    """
+    await db.execute(
+        "ALTER TABLE bets4sats.tickets ADD COLUMN reward_target_status TEXT NOT NULL DEFAULT 'VALID';"
+    )
+    await db.execute(
+        "ALTER TABLE bets4sats.tickets ADD COLUMN reward_target_error TEXT NOT NULL DEFAULT '';"
+    )
+
+
+async def m012_tickets_competition_keyset_indexes(db):
+    """
+    Indexes for walking a competition's tickets in chunks when settling it, by id or by
+    reward target for aggregated payouts.
+    """
+    for index_name, columns in (
+        ("tickets_competition_id", "competition, id"),
+        ("tickets_competition_reward_target", "competition, reward_target"),
+    ):
+        if db.type == SQLITE:
+            await db.execute(f"CREATE INDEX bets4sats.{index_name} ON tickets ({columns});")
+        else:
+            await db.execute(f"CREATE INDEX {index_name} ON bets4sats.tickets ({columns});")
+
+
+async def m013_competitions_outstanding_payouts(db):
+    """
+    Number of tickets of a completed competition still to be paid, so that finding out
+    whether it is fully paid doesn't scan its tickets.
+    """
+    await db.execute(
+        "ALTER TABLE bets4sats.competitions ADD COLUMN outstanding_payouts INTEGER NOT NULL DEFAULT 0;"
+    )
+    await db.execute(
+        """
+        UPDATE bets4sats.competitions
+        SET outstanding_payouts = (
+            SELECT COUNT(*) FROM bets4sats.tickets
+            WHERE tickets.competition = competitions.id AND tickets.state IN (?, ?, ?, ?)
+        )
+        WHERE state = ?
+        """,
+        ("WON_UNPAID", "WON_PAYING", "CANCELLED_UNPAID", "CANCELLED_PAYING", "COMPLETED_PAYING"),
+    )
+
+
+async def m014_tickets_payout_msat(db):
+    """
+    Amount each ticket is owed, computed once when its competition is completed instead of
+    by every payout. Backfilled without the rounding dust for competitions completed before.
+    """
+    await db.execute(
+        f"ALTER TABLE bets4sats.tickets ADD COLUMN payout_msat {db.big_int} NOT NULL DEFAULT 0;"
+    )
+    await db.execute(
+        """
+        UPDATE bets4sats.tickets
+        SET payout_msat = CAST(amount AS BIGINT) * 1000
+        WHERE state LIKE ?
+        """,
+        ("CANCELLED_%",),
+    )
+    competitions = await db.fetchall(
+        "SELECT id, winning_choice FROM bets4sats.competitions WHERE state != ? AND winning_choice >= 0",
+        ("INITIAL",),
+    )
+    for competition in competitions:
+        totals = await db.fetchall(
+            "SELECT choice, total FROM bets4sats.choices WHERE competition = ?",
+            (competition["id"],),
+        )
+        totals = {row["choice"]: row["total"] for row in totals}
+        winning_total = totals.get(competition["winning_choice"], 0)
+        if winning_total <= 0:
+            continue
+        # PRIZE_FEE_PERCENT of tasks.py at the time of this migration
+        prize_pool_msat = sum(totals.values()) * 1000 * (100 - 1) // 100
+        await db.execute(
+            """
+            UPDATE bets4sats.tickets
+            SET payout_msat = CAST(amount AS BIGINT) * ? / ?
+            WHERE competition = ? AND state LIKE ?
+            """,
+            (prize_pool_msat, winning_total, competition["id"], "WON_%"),
+        )
+
+
+async def m015_banners(db):
+    """
+    Move banners out of the competitions rows, into a table keyed by their sha256, so that
+    competition queries don't carry them and they can be served with immutable caching.
+    """
+    await db.execute(
+        """
+        CREATE TABLE bets4sats.banners (
+            hash TEXT PRIMARY KEY,
+            banner TEXT NOT NULL
+        );
+    """
+    )
+    await db.execute(
+        "ALTER TABLE bets4sats.competitions ADD COLUMN banner_hash TEXT NOT NULL DEFAULT '';"
+    )
+    competitions = await db.fetchall(
+        "SELECT id, banner FROM bets4sats.competitions WHERE banner != ?", ("",)
+    )
+    for competition in competitions:
+        banner_hash = hashlib.sha256(competition["banner"].encode()).hexdigest()
+        await db.execute(
+            "INSERT INTO bets4sats.banners (hash, banner) VALUES (?, ?) ON CONFLICT (hash) DO NOTHING",
+            (banner_hash, competition["banner"]),
+        )
+        await db.execute(
+            "UPDATE bets4sats.competitions SET banner = ?, banner_hash = ? WHERE id = ?",
+            ("", banner_hash, competition["id"]),
+        )
+
+
+async def m016_ticket_counts(db):
+    """
+    Tickets, sats bet and msats paid out per competition and ticket state, kept up to date
+    by every state change, for the summary of the admin page.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE bets4sats.ticket_counts (
+            competition TEXT NOT NULL,
+            wallet TEXT NOT NULL,
+            state TEXT NOT NULL,
+            tickets INTEGER NOT NULL,
+            amount {db.big_int} NOT NULL,
+            reward_msat {db.big_int} NOT NULL,
+            PRIMARY KEY (competition, state)
+        );
+    """
+    )
+    if db.type == SQLITE:
+        await db.execute("CREATE INDEX bets4sats.ticket_counts_wallet ON ticket_counts (wallet);")
+    else:
+        await db.execute("CREATE INDEX ticket_counts_wallet ON bets4sats.ticket_counts (wallet);")
+    await db.execute(
+        """
+        INSERT INTO bets4sats.ticket_counts (competition, wallet, state, tickets, amount, reward_msat)
+        SELECT competition, wallet, state, COUNT(*), SUM(amount), SUM(reward_msat)
+        FROM bets4sats.tickets
+        GROUP BY competition, wallet, state
+        """
+    )
+
+
+async def m017_competitions_settle_aggregate(db):
+    """
+    How a completed competition is paid out, stored when it is completed, so that an
+    interrupted settlement can be resumed. The winning choice is stored already.
+    """
+    await db.execute(
+        "ALTER TABLE bets4sats.competitions ADD COLUMN settle_aggregate BOOLEAN NOT NULL DEFAULT false;"
+    )
+
+
+async def m018_competitions_state_index(db):
+    """
+    Index for finding the completed competitions whose settlement is to be resumed.
+    """
+    if db.type == SQLITE:
+        await db.execute("CREATE INDEX bets4sats.competitions_state ON competitions (state);")
+    else:
+        await db.execute("CREATE INDEX competitions_state ON bets4sats.competitions (state);")
+
+
+async def m019_ticket_deletions(db):
+    """
+    Tombstones of deleted tickets, so that the change feed of the registration page can tell
+    its clients which tickets to drop, as it does for those changed since they last synced.
+    """
+    await db.execute(
+        """
+        CREATE TABLE bets4sats.ticket_deletions (
+            ticket TEXT PRIMARY KEY,
+            competition TEXT NOT NULL,
+            deleted INTEGER NOT NULL
+        );
+    """
+    )
+    if db.type == SQLITE:
+        await db.execute("CREATE INDEX bets4sats.ticket_deletions_competition ON ticket_deletions (competition, deleted);")
+    else:
+        await db.execute("CREATE INDEX ticket_deletions_competition ON bets4sats.ticket_deletions (competition, deleted);")
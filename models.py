@@ -21,6 +21,7 @@ class UpdateCompetition(BaseModel):
 
 class CompleteCompetition(BaseModel):
     winning_choice: int # -1 for cancellation
+    aggregate_payouts: bool = False # one payment per reward target instead of per ticket
 
 class CreateInvoiceForTicket(BaseModel):
     reward_target: str
@@ -33,7 +34,8 @@ class Competition(BaseModel):
     register_id: str
     name: str
     info: str
-    banner: str
+    # sha256 of the banner in bets4sats.banners, empty without banner
+    banner_hash: str
     closing_datetime: str
     amount_tickets: int
     min_bet: int
@@ -44,6 +46,10 @@ class Competition(BaseModel):
     # states: INITIAL, COMPLETED_PAYING, COMPLETED_PAID, COMPLETED_PAID_ALL
     state: str
     time: int
+    # tickets of a completed competition not paid yet
+    outstanding_payouts: int = 0
+    # whether the payouts of a completed competition are one per reward target
+    settle_aggregate: bool = False
 
 
 class Ticket(BaseModel):
@@ -59,14 +65,43 @@ class Ticket(BaseModel):
     reward_msat: int
     reward_failure: str
     reward_payment_hash: str
+    payment_hash: str
     time: int
+    updated: int
+    # PENDING while the reward target is verified in the background, then VALID or INVALID
+    reward_target_status: str
+    reward_target_error: str
+    # owed to the reward target, set when the competition is completed
+    payout_msat: int = 0
 
 class ChoiceAmountSum(BaseModel):
     choice: int
     amount_sum: int
 
+class ChoiceTotal(BaseModel):
+    competition: str
+    choice: int
+    total: int
+    sold: int
+
 class LnurlpParameters(BaseModel):
     minSendable: int
     maxSendable: int
     callback: str
     commentAllowed: int
+
+class Payout(BaseModel):
+    ticket: str
+    competition: str
+    claim: str
+    aggregate: bool
+
+
+class TicketCount(BaseModel):
+    # tickets of a competition in a state, maintained by the crud state transitions
+    competition: str
+    wallet: str
+    state: str
+    tickets: int
+    amount: int
+    reward_msat: int
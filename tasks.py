@@ -1,25 +1,62 @@
 import asyncio
 import json
-from time import sleep
+import time
+from collections import deque
+from typing import Deque, Dict, List, Set
 
-from lnbits.core.models import Payment
+from lnbits.core.crud import get_payments
+from lnbits.core.models import Payment, PaymentFilters
+from lnbits.db import Filters, Filter
 from lnbits.helpers import get_current_extension_name
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .crud import cas_competition_state, get_ticket, cas_ticket_state, get_competition, update_ticket, is_competition_payment_complete, get_all_competitions, TICKET_PURGE_TIME
-from .helpers import pay_lnurlp, send_ticket
+from . import metrics
+from .crud import cas_competition_state, count_competition_payouts_to_enqueue, get_competition, get_unsettled_competitions, enqueue_competition_payouts, set_ticket_payouts, sum_choices_amounts, update_competition_winners, get_ticket, cas_ticket_state, finish_ticket_payout, is_competition_payment_complete, get_next_ticket_purge_time, purge_expired_tickets, claim_payouts, count_payouts, delete_payout, refresh_payout_claim, release_payout_claims, get_reward_target_tickets, PAYOUT_CLAIM_TIMEOUT
+from .helpers import HostSlots, get_reward_host, pay_lnurlp, send_ticket
+from .models import Payout, Ticket
 
 PRIZE_FEE_PERCENT = 1
 
+# Set whenever a ticket is created, to wake up purge_tickets_loop if it has no deadline
+ticket_created_event = asyncio.Event()
+
 async def purge_tickets_loop():
     while True:
-        sleep(TICKET_PURGE_TIME // 2)
-        await competitions = await get_all_competitions()
-        for competition in competitions:
-            await purge_expired_tickets(competition.id)
+        ticket_created_event.clear()
+        purge_time = await get_next_ticket_purge_time()
+        if purge_time is None:
+            await ticket_created_event.wait()
+            continue
+        delay = purge_time - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        purged = await purge_expired_tickets()
+        metrics.inc("bets4sats_purged_tickets_total", "Unpaid tickets purged after their invoice expired", purged)
+        logger.info(f"purge_tickets_loop: purged {purged} expired tickets")
+
+# Set when payouts are added to the outbox, to wake up wait_for_reward_ticket_ids
+payout_wakeup_event = asyncio.Event()
+
+# Queues of clients waiting for a ticket's invoice to be paid, by ticket id
+ticket_paid_subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+def subscribe_ticket_paid(ticket_id: str) -> asyncio.Queue:
+    queue = asyncio.Queue()
+    ticket_paid_subscribers.setdefault(ticket_id, set()).add(queue)
+    return queue
 
-reward_ticket_ids_queue = asyncio.Queue()
+def unsubscribe_ticket_paid(ticket_id: str, queue: asyncio.Queue) -> None:
+    queues = ticket_paid_subscribers.get(ticket_id)
+    if queues is None:
+        return
+    queues.discard(queue)
+    if not queues:
+        del ticket_paid_subscribers[ticket_id]
+
+def notify_ticket_paid(ticket_id: str) -> None:
+    for queue in ticket_paid_subscribers.get(ticket_id, ()):
+        queue.put_nowait(True)
 
 async def wait_for_paid_invoices():
     invoice_queue = asyncio.Queue()
@@ -40,92 +77,379 @@ async def on_invoice_paid(payment: Payment) -> None:
         and payment.memo and payment.memo.startswith("Bets4SatsTicketId:")
     ):
         competition_id, ticket_id = (payment.memo[len("Bets4SatsTicketId:"):].split(".") + [""])[:2]
-        await send_ticket(
+        response = await send_ticket(
             competition_id,
             ticket_id,
         )
+        metrics.inc("bets4sats_paid_invoices_total", "Ticket invoices reported by the invoice listener")
+        if response["paid"]:
+            notify_ticket_paid(ticket_id)
     return
 
+SETTLEMENT_CHUNK = 1000 # tickets, or reward targets, added to the outbox per statement
+
+# Progress of competition settlements run by this process, by competition id
+settlement_jobs: Dict[str, Dict] = {}
+# Keeps references to the settlement tasks until they are done
+settlement_tasks: Set[asyncio.Task] = set()
+
+def start_settlement(competition_id: str, winning_choice: int, aggregate: bool) -> Dict:
+    """
+    Settles a competition in COMPLETED_PAYING in the background, or resumes or retries
+    settling it, as every step is idempotent. Returns the job, the running one if any.
+    """
+    job = settlement_jobs.get(competition_id)
+    if job and job["state"] == "RUNNING":
+        return job
+    job = settlement_jobs[competition_id] = {
+        "competition": competition_id,
+        "state": "RUNNING",
+        "total": None,
+        "enqueued": 0,
+        "error": "",
+    }
+    task = asyncio.create_task(settle_competition(job, winning_choice, aggregate))
+    settlement_tasks.add(task)
+    task.add_done_callback(settlement_tasks.discard)
+    return job
+
+async def resume_settlements() -> None:
+    # Settlements interrupted by a restart, or that failed
+    for competition in await get_unsettled_competitions():
+        logger.info(f"resume_settlements: resuming {competition.id}")
+        start_settlement(competition.id, competition.winning_choice, competition.settle_aggregate)
+
+async def settle_competition(job: Dict, winning_choice: int, aggregate: bool) -> None:
+    competition_id = job["competition"]
+    try:
+        competition = await get_competition(competition_id)
+        choices = json.loads(competition.choices)
+        for choice in choices:
+            choice.setdefault("pre_agg_total", choice["total"])
+            choice["total"] = 0
+        # Tickets refunded because they were paid after completion are left out of the pool
+        for choice_amount_sum in await sum_choices_amounts(competition_id, include_cancelled=winning_choice < 0):
+            choices[choice_amount_sum.choice]["total"] = choice_amount_sum.amount_sum
+        await update_competition_winners(competition_id, json.dumps(choices), winning_choice)
+        # What every ticket is owed is settled here, so payouts only read it
+        if winning_choice >= 0:
+            pool_msat = sum(choice["total"] for choice in choices) * 1000
+            await set_ticket_payouts(competition_id, pool_msat * (100 - PRIZE_FEE_PERCENT) // 100, choices[winning_choice]["total"])
+        else:
+            await set_ticket_payouts(competition_id, 0, 0)
+        job["total"] = await count_competition_payouts_to_enqueue(competition_id, aggregate)
+        after = None
+        while True:
+            enqueued, after = await enqueue_competition_payouts(competition_id, aggregate, after, SETTLEMENT_CHUNK)
+            if after is None:
+                break
+            job["enqueued"] += enqueued
+            # Payouts of the first chunks start while the rest are added
+            payout_wakeup_event.set()
+        job["state"] = "DONE"
+        # Nothing to pay, or payouts of the first chunks all done already
+        await check_competition_payment_complete(competition_id)
+        logger.info(f"settle_competition: enqueued {job['enqueued']} payouts: {competition_id}")
+    except Exception as exception:
+        job["state"] = "FAILED"
+        job["error"] = str(exception)
+        logger.error(f"settle_competition: failed: {competition_id} {exception}")
+
+PAYOUT_CLAIM_BATCH = 50
+PAYOUT_POLL_INTERVAL = 60 # seconds, to take over claims that timed out
+PAYOUT_CLAIM_REFRESH_INTERVAL = PAYOUT_CLAIM_TIMEOUT / 3 # seconds, while a payout runs
+PAYOUT_WORKERS = 8 # payouts in flight at once
+PAYOUT_HOST_WORKERS = 2 # payouts in flight at once to the same lnurl host
+
+payout_slots = asyncio.Semaphore(PAYOUT_WORKERS)
+payout_host_slots = HostSlots(PAYOUT_HOST_WORKERS)
+# Payout tasks of this process by ticket id, which keeps references to them until they are
+# done, and keeps a payout from running twice when its claim is taken over
+payouts_in_flight: Dict[str, asyncio.Task] = {}
+payout_stats = {
+    "in_flight": 0,
+    "completed": 0,
+    "latency_sum": 0.0,
+    "latency_max": 0.0,
+}
+payout_latencies: Deque[float] = deque(maxlen=1000)
+
+payouts_resumed = False
+
+async def get_payout_stats() -> Dict:
+    latencies = sorted(payout_latencies)
+    return {
+        "queue_depth": await count_payouts(),
+        **payout_stats,
+        "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+        "latency_p99": latencies[len(latencies) * 99 // 100] if latencies else 0.0,
+    }
+
+async def acquire_payout_slots(limit: int) -> int:
+    # Waits for a free payout worker, then takes the other free ones, up to limit
+    await payout_slots.acquire()
+    slots = 1
+    while slots < limit and not payout_slots.locked():
+        await payout_slots.acquire()
+        slots += 1
+    return slots
+
 async def wait_for_reward_ticket_ids():
+    global payouts_resumed
     logger.info("wait_for_reward_ticket_ids: started")
+    if not payouts_resumed:
+        # Claims left by a previous process are resumed right away instead of timing out.
+        # Only once, as a restart by catch_everything_and_restart keeps our own workers running.
+        resumed = await release_payout_claims()
+        payouts_resumed = True
+        logger.info(f"wait_for_reward_ticket_ids: resumed {resumed} payouts")
+        await resume_settlements()
     while True:
-        ticket_id = await reward_ticket_ids_queue.get()
-        await on_reward_ticket_id(ticket_id)
+        payout_wakeup_event.clear()
+        # Only as many payouts are claimed as there are free workers to run them, so that
+        # claims don't time out while waiting in memory
+        slots = await acquire_payout_slots(PAYOUT_CLAIM_BATCH)
+        try:
+            payouts = await claim_payouts(slots)
+            for payout in payouts:
+                if payout.ticket in payouts_in_flight:
+                    # Its claim timed out while still running here
+                    logger.warning(f"wait_for_reward_ticket_ids: already in flight: {payout.ticket}")
+                    continue
+                payouts_in_flight[payout.ticket] = asyncio.create_task(run_reward_ticket_id(payout))
+                slots -= 1
+        finally:
+            for _ in range(slots):
+                payout_slots.release()
+        if not payouts:
+            try:
+                await asyncio.wait_for(payout_wakeup_event.wait(), PAYOUT_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+async def keep_payout_claimed(payout: Payout) -> None:
+    # Refreshes the claim of a running payout, so another worker doesn't take it over while
+    # it waits for a busy host or for a slow payment
+    while True:
+        await asyncio.sleep(PAYOUT_CLAIM_REFRESH_INTERVAL)
+        if not await refresh_payout_claim(payout.ticket, payout.claim):
+            logger.warning(f"keep_payout_claimed: claim lost: {payout.ticket}")
+            return
+
+async def run_reward_ticket_id(payout: Payout) -> None:
+    # Called holding a payout slot, which is released when done. The slot and the claim are
+    # held while waiting for a busy host, so no more payouts are claimed than can run.
+    ticket_id = payout.ticket
+    claim_keeper = asyncio.create_task(keep_payout_claimed(payout))
+    try:
+        ticket = await get_ticket(ticket_id)
+        host = get_reward_host(ticket.reward_target) if ticket else ""
+        async with payout_host_slots.use(host) as host_slots:
+            async with host_slots:
+                payout_stats["in_flight"] += 1
+                start = time.monotonic()
+                try:
+                    done = await on_reward_ticket_id(ticket_id, payout.aggregate)
+                    if done:
+                        await delete_payout(ticket_id)
+                finally:
+                    latency = time.monotonic() - start
+                    payout_stats["in_flight"] -= 1
+                    payout_stats["completed"] += 1
+                    payout_stats["latency_sum"] += latency
+                    payout_stats["latency_max"] = max(payout_stats["latency_max"], latency)
+                    payout_latencies.append(latency)
+                    metrics.observe("bets4sats_payout_seconds", "Latency of payout workers per outbox row", latency)
+    except Exception as exception:
+        logger.warning(f"run_reward_ticket_id: failed: {ticket_id} {exception}")
+    finally:
+        claim_keeper.cancel()
+        del payouts_in_flight[ticket_id]
+        payout_slots.release()
+
+PAYING_STATES = {
+    "WON_UNPAID": "WON_PAYING",
+    "WON_PAYMENT_FAILED": "WON_PAYING",
+    "CANCELLED_UNPAID": "CANCELLED_PAYING",
+    "CANCELLED_PAYMENT_FAILED": "CANCELLED_PAYING"
+}
+PAID_STATES = {
+    "CANCELLED_PAYING": "CANCELLED_PAID",
+    "WON_PAYING": "WON_PAID"
+}
+PAYMENT_FAILED_STATES = {
+    "CANCELLED_PAYING": "CANCELLED_PAYMENT_FAILED",
+    "WON_PAYING": "WON_PAYMENT_FAILED"
+}
+UNPAID_STATES = {
+    "CANCELLED_PAYING": "CANCELLED_UNPAID",
+    "WON_PAYING": "WON_UNPAID"
+}
+
+# Tickets moved to *_PAYING by the payouts of this process, until they are settled, so that
+# they aren't taken for the leftovers of an interrupted worker while paid
+tickets_paying: Set[str] = set()
+
+def get_description_prefix(ticket: Ticket) -> str:
+    return "Bets4SatsRefund" if ticket.state.startswith("CANCELLED_") else "Bets4SatsReward"
+
+def split_reward_msat(final_reward_msat: int, rewards_msat: List[int]) -> List[int]:
+    # Share of each ticket in an aggregated payment, the rounding remainder goes to the first
+    total_reward_msat = sum(rewards_msat)
+    if not total_reward_msat:
+        # Nothing to split by, e.g. a group of zero payouts
+        return [final_reward_msat] + [0] * (len(rewards_msat) - 1)
+    shares = [final_reward_msat * reward_msat // total_reward_msat for reward_msat in rewards_msat]
+    shares[0] += final_reward_msat - sum(shares)
+    return shares
 
-async def on_reward_ticket_id(ticket_id: str) -> None:
+async def get_paying_group(ticket: Ticket, aggregate: bool) -> List[Ticket]:
+    # The tickets paid together with `ticket`, which is always first
+    if not aggregate:
+        return [ticket]
+    siblings = await get_reward_target_tickets(ticket.competition, ticket.reward_target, [ticket.state])
+    return [ticket] + [sibling for sibling in siblings if sibling.id != ticket.id]
+
+async def recover_paying_ticket(ticket: Ticket, aggregate: bool) -> bool:
+    """
+    Settle a ticket (and its aggregated group) left in *_PAYING by an interrupted worker,
+    according to the payment it made, if any. Returns False if that payment is still pending,
+    or if a worker of this process is still paying it.
+    """
+    group = await get_paying_group(ticket, aggregate)
+    # Claims are refreshed while their payout runs, so this is only reached once a claim
+    # expired, but a payout may also have moved it to *_PAYING as part of its aggregated group
+    if any(group_ticket.id in tickets_paying for group_ticket in group):
+        logger.info(f"recover_paying_ticket: still being paid: {ticket.id}")
+        return False
+    payments = await get_payments(
+        wallet_id=ticket.wallet,
+        outgoing=True,
+        limit=1,
+        filters=Filters(
+            filters=[Filter(
+              field="memo",
+              values=[f"{get_description_prefix(ticket)}:{ticket.competition}.{ticket.id}"],
+              model=PaymentFilters
+            )],
+            model=PaymentFilters,
+        )
+    )
+    if payments and payments[0].pending:
+        return False
+    if payments:
+        logger.info(f"recover_paying_ticket: found payment: {ticket.id}")
+        rewards_msat = [group_ticket.payout_msat for group_ticket in group]
+        shares = split_reward_msat(abs(payments[0].amount), rewards_msat)
+        for group_ticket, share in zip(group, shares):
+            await finish_ticket_payout(
+                group_ticket.id,
+                group_ticket.state,
+                PAID_STATES[group_ticket.state],
+                reward_failure="",
+                reward_msat=share,
+                reward_payment_hash=payments[0].payment_hash
+            )
+    else:
+        logger.info(f"recover_paying_ticket: no payment, retrying: {ticket.id}")
+        for group_ticket in group:
+            await cas_ticket_state(group_ticket.id, group_ticket.state, UNPAID_STATES[group_ticket.state])
+    return True
+
+async def check_competition_payment_complete(competition_id: str) -> None:
+    competition_complete = await is_competition_payment_complete(competition_id)
+    logger.info(f"check_competition_payment_complete: {competition_id} {competition_complete}")
+    if competition_complete:
+        await cas_competition_state(
+            competition_id,
+            "COMPLETED_PAYING",
+            "COMPLETED_PAID"
+        )
+
+async def on_reward_ticket_id(ticket_id: str, aggregate: bool = False) -> bool:
+    """
+    Pay the reward or refund of a ticket. With aggregate, the other tickets of the same
+    competition and reward target are paid in the same payment.
+    Returns False if it should be retried later.
+    """
     logger.info(f"on_reward_ticket_id: called {ticket_id}")
     ticket = await get_ticket(ticket_id)
     if not ticket:
         logger.warning(f"on_reward_ticket_id: ticket not found, deleted before handled? {ticket_id}")
-        return
+        return True
+    if ticket.state in ("WON_PAYING", "CANCELLED_PAYING"):
+        if not await recover_paying_ticket(ticket, aggregate):
+            return False
+        ticket = await get_ticket(ticket_id)
+        if not ticket:
+            return True
+        if ticket.state in PAID_STATES.values():
+            await check_competition_payment_complete(ticket.competition)
+            return True
     logger.info(f"on_reward_ticket_id: handling ticket: {ticket}")
-    new_state = {
-        "WON_UNPAID": "WON_PAYING",
-        "WON_PAYMENT_FAILED": "WON_PAYING",
-        "CANCELLED_UNPAID": "CANCELLED_PAYING",
-        "CANCELLED_PAYMENT_FAILED": "CANCELLED_PAYING"
-    }.get(ticket.state)
+    new_state = PAYING_STATES.get(ticket.state)
     logger.info(f"on_reward_ticket_id: new state: {ticket_id} {new_state}")
     if not new_state:
-        return
-    cas_success = await cas_ticket_state(ticket_id, ticket.state, new_state)
-    if not cas_success:
+        return True
+    group = []
+    for group_ticket in await get_paying_group(ticket, aggregate):
+        # Tickets that fail the cas are handled by someone else
+        if await cas_ticket_state(group_ticket.id, group_ticket.state, new_state):
+            group.append(group_ticket)
+    if not group or group[0].id != ticket_id:
         logger.info(f"on_reward_ticket_id: cas failed: {ticket_id}")
-        return
+        for group_ticket in group:
+            await cas_ticket_state(group_ticket.id, new_state, group_ticket.state)
+        return True
+    group_ids = [group_ticket.id for group_ticket in group]
+    tickets_paying.update(group_ids)
+    try:
+        await pay_ticket_group(ticket_id, group, new_state)
+    finally:
+        tickets_paying.difference_update(group_ids)
+    await check_competition_payment_complete(ticket.competition)
+    return True
+
+async def pay_ticket_group(ticket_id: str, group: List[Ticket], new_state: str) -> None:
+    # Pays the tickets moved to new_state (*_PAYING) together, and settles them as paid or failed
     final_reward_msat = 0
     try:
-        # get ticket again
-        ticket = await get_ticket(ticket_id)
-        if not ticket:
-            logger.info(f"on_reward_ticket_id: failed to re-get ticket: {ticket_id}")
+        # get tickets again
+        group = [await get_ticket(group_ticket.id) for group_ticket in group]
+        if not all(group):
+            logger.info(f"on_reward_ticket_id: failed to re-get tickets: {ticket_id}")
             return
-        if ticket.state == "CANCELLED_PAYING":
-            reward_msat = ticket.amount * 1000
-            description_prefix = "Bets4SatsRefund"
-        else: # WON_PAYING
-            competition = await get_competition(ticket.competition)
-            logger.info(f"on_reward_ticket_id: got competition: {ticket_id} {competition}")
-            choices = json.loads(competition.choices)
-            logger.info(f"on_reward_ticket_id: calculating reward: {ticket_id}")
-            total_msat = sum(choice["total"] for choice in choices) * 1000
-            reward_msat = total_msat * ticket.amount * (100 - PRIZE_FEE_PERCENT) // (choices[ticket.choice]["total"] * 100)
-            description_prefix = "Bets4SatsReward"
-        logger.info(f"on_reward_ticket_id: reward_msat: {ticket_id} {reward_msat}")
+        ticket = group[0]
+        rewards_msat = [group_ticket.payout_msat for group_ticket in group]
+        reward_msat = sum(rewards_msat)
+        logger.info(f"on_reward_ticket_id: reward_msat: {ticket_id} {reward_msat} ({len(group)} tickets)")
         logger.info(f"on_reward_ticket_id: paying lnurlp: {ticket_id}")
         payment_hash, final_reward_msat = await pay_lnurlp(
             ticket.wallet,
             ticket.reward_target,
             reward_msat,
-            f"{description_prefix}:{ticket.competition}.{ticket.id}",
-            {"tag":"bets4sats"}
+            f"{get_description_prefix(ticket)}:{ticket.competition}.{ticket.id}",
+            {"tag": "bets4sats", "ticket_ids": [group_ticket.id for group_ticket in group]}
         )
     except Exception as exception:
         logger.warning(f"on_reward_ticket_id: failed: {ticket_id} {exception}")
-        await update_ticket(
-            ticket_id,
-            state={
-                "CANCELLED_PAYING": "CANCELLED_PAYMENT_FAILED",
-                "WON_PAYING": "WON_PAYMENT_FAILED"
-            }[ticket.state],
-            reward_failure=str(exception)
-        )
+        metrics.inc("bets4sats_payouts_total", "Reward and refund payments by result", result="failed")
+        for group_ticket in group:
+            await finish_ticket_payout(
+                group_ticket.id,
+                new_state,
+                PAYMENT_FAILED_STATES[new_state],
+                reward_failure=str(exception)
+            )
     else:
-        logger.info(f"on_reward_ticket_id: updating ticket to paid: {ticket_id}")
-        await update_ticket(
-            ticket.id,
-            state={
-                "CANCELLED_PAYING": "CANCELLED_PAID",
-                "WON_PAYING": "WON_PAID"
-            }[ticket.state],
-            reward_failure="",
-            reward_msat=final_reward_msat,
-            reward_payment_hash=payment_hash
-        )
-    competition_complete = await is_competition_payment_complete(ticket.competition)
-    logger.info(f"on_reward_ticket_id: competition_complete: {ticket_id} {competition_complete}")
-    if competition_complete:
-        await cas_competition_state(
-            ticket.competition,
-            "COMPLETED_PAYING",
-            "COMPLETED_PAID"
-        )
+        logger.info(f"on_reward_ticket_id: updating tickets to paid: {ticket_id}")
+        metrics.inc("bets4sats_payouts_total", "Reward and refund payments by result", result="paid")
+        for group_ticket, share in zip(group, split_reward_msat(final_reward_msat, rewards_msat)):
+            await finish_ticket_payout(
+                group_ticket.id,
+                new_state,
+                PAID_STATES[new_state],
+                reward_failure="",
+                reward_msat=share,
+                reward_payment_hash=payment_hash
+            )
@@ -0,0 +1,278 @@
+"""
+Benchmark of the crud functions against the in-memory sqlite database of harness.py, seeded
+with --competitions competitions of --tickets funded tickets each.
+
+    python tests/bench_crud.py --competitions 20 --tickets 5000 --output crud.json
+    python tests/bench_crud.py --tasks 50 --output contention.json
+
+Reports the latency percentiles and sql statements of every call. With --tasks, N tasks
+then buy, settle and pay the tickets of one more competition at once, reporting the
+compare-and-swap updates that lost and the transactions that waited for the database lock.
+Save the reports of two branches to compare them, e.g. after a schema change.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from harness import Extension, load_extension
+from load_test import cas_failures, percentiles
+
+
+class Timings:
+    """
+    Latencies of the calls made through measure(), by name, and their sql statements unless
+    calls run concurrently, as those of concurrent calls can't be told apart.
+    """
+
+    def __init__(self, ext: Extension, count_statements: bool = True):
+        self.ext = ext
+        self.count_statements = count_statements
+        self.latencies: Dict[str, List[float]] = {}
+        self.statements: Dict[str, int] = {}
+
+    async def measure(self, name: str, call: Callable[..., Awaitable], *args):
+        if self.count_statements:
+            self.ext.db.statements = []
+        start = time.perf_counter()
+        try:
+            return await call(*args)
+        finally:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if self.count_statements:
+                self.statements[name] = self.statements.get(name, 0) + len(self.ext.db.statements)
+                self.ext.db.statements = None
+
+    def report(self) -> Dict:
+        report = {}
+        for name, latencies in self.latencies.items():
+            report[name] = {"calls": len(latencies), "mean": sum(latencies) / len(latencies), **percentiles(latencies)}
+            if self.count_statements:
+                report[name]["statements"] = self.statements[name] / len(latencies)
+        return report
+
+
+async def buy_ticket(ext: Extension, competition, index: int):
+    # Without an invoice, to measure the database alone
+    return await ext.crud.create_ticket(
+        ticket_id=uuid.uuid4().hex[:22],
+        wallet=competition.wallet,
+        competition=competition.id,
+        amount=1000 + index % 1000,
+        reward_target=f"user{index % 100}@example.com",
+        choice=index % 2,
+        payment_hash=uuid.uuid4().hex,
+    )
+
+
+async def seed(ext: Extension, wallet: str, competitions: int, tickets: int) -> list:
+    # Through the crud functions, so the counters and choice totals are consistent
+    seeded = []
+    for _ in range(competitions):
+        competition = await ext.create_competition(wallet, amount_tickets=tickets * 2)
+        for index in range(tickets):
+            ticket = await buy_ticket(ext, competition, index)
+            await ext.crud.set_ticket_funded(ticket.id)
+        seeded.append(competition)
+    return seeded
+
+
+async def settle(ext: Extension, timings: Timings, competition, winning_choice: int = 0) -> None:
+    # What settle_competition does with the database, once completed
+    crud = ext.crud
+    sums = await timings.measure("sum_choices_amounts", crud.sum_choices_amounts, competition.id, False)
+    totals = {row.choice: row.amount_sum for row in sums}
+    choices = json.loads(competition.choices)
+    for index, choice in enumerate(choices):
+        choice["total"] = totals.get(index, 0)
+    await timings.measure(
+        "update_competition_winners", crud.update_competition_winners, competition.id, json.dumps(choices), winning_choice
+    )
+    pool_msat = sum(totals.values()) * 1000
+    await timings.measure(
+        "set_ticket_payouts", crud.set_ticket_payouts, competition.id, pool_msat * 99 // 100, totals.get(winning_choice, 0)
+    )
+    after = None
+    while True:
+        _, after = await timings.measure("enqueue_competition_payouts", crud.enqueue_competition_payouts, competition.id, False, after)
+        if after is None:
+            break
+
+
+async def pay(ext: Extension, timings: Timings, counts: Dict[str, int]) -> None:
+    # What a payout worker does with the database, without paying
+    crud = ext.crud
+    while True:
+        payouts = await timings.measure("claim_payouts", crud.claim_payouts, 10)
+        counts["claims"] += 1
+        if not payouts:
+            return
+        for payout in payouts:
+            ticket = await timings.measure("get_ticket", crud.get_ticket, payout.ticket)
+            paying_state = ticket.state.replace("UNPAID", "PAYING")
+            counts["cas_attempts"] += 1
+            if await timings.measure("cas_ticket_state", crud.cas_ticket_state, ticket.id, ticket.state, paying_state):
+                await timings.measure(
+                    "finish_ticket_payout", crud.finish_ticket_payout, ticket.id, paying_state, paying_state.replace("PAYING", "PAID")
+                )
+            await timings.measure("delete_payout", crud.delete_payout, payout.ticket)
+
+
+async def bench_functions(ext: Extension, args, competitions: list) -> Dict:
+    crud = ext.crud
+    timings = Timings(ext)
+    competition = competitions[0]
+    wallet = competition.wallet
+    tickets = []
+    for index in range(args.repeat):
+        tickets.append(await timings.measure("create_ticket", buy_ticket, ext, competition, index))
+    for ticket in tickets:
+        await timings.measure("set_ticket_funded", crud.set_ticket_funded, ticket.id)
+    for ticket in tickets:
+        await timings.measure("get_ticket", crud.get_ticket, ticket.id)
+    since = int(time.time())
+    for index in range(args.repeat):
+        crud.competition_cache.clear()
+        await timings.measure("get_competition", crud.get_competition, competitions[index % len(competitions)].id)
+        await timings.measure("get_ticket_rows", crud.get_ticket_rows, [wallet], 100, (0, tickets[index].id))
+        await timings.measure("get_competition_rows", crud.get_competition_rows, [wallet], 100)
+        await timings.measure("get_wallet_competition_ticket_rows", crud.get_wallet_competition_ticket_rows, competition.id, since)
+        await timings.measure("get_ticket_counts", crud.get_ticket_counts, [wallet])
+    for _ in range(min(args.repeat, 10)):
+        # They read every ticket of the competition
+        await timings.measure("get_wallet_competition_ticket_rows (all)", crud.get_wallet_competition_ticket_rows, competition.id)
+        await timings.measure("get_state_competition_tickets", crud.get_state_competition_tickets, competition.id, ["FUNDED"])
+    for index in range(args.repeat):
+        expired = await buy_ticket(ext, competition, index)
+        await ext.db.execute("UPDATE bets4sats.tickets SET time = time - ? WHERE id = ?", (crud.TICKET_PURGE_TIME, expired.id))
+        await timings.measure("purge_expired_tickets", crud.purge_expired_tickets)
+    for competition in competitions:
+        await timings.measure("complete_competition", crud.complete_competition, competition.id, 0, False)
+        await settle(ext, timings, competition)
+    counts = {"claims": 0, "cas_attempts": 0}
+    await pay(ext, timings, counts)
+    return timings.report()
+
+
+async def bench_contention(ext: Extension, args, wallet: str) -> Dict:
+    """
+    N tasks buy the tickets of one competition until sold out, race to complete it, then
+    drain its payouts like N payout workers.
+    """
+    crud = ext.crud
+    db = ext.db
+    timings = Timings(ext, count_statements=False)
+    competition = await ext.create_competition(wallet, amount_tickets=args.tickets)
+    phases = {}
+
+    def snapshot() -> Dict:
+        return {
+            "time": time.perf_counter(),
+            "transactions": db.transactions,
+            "lock_waits": db.lock_waits,
+            "cas_failures": cas_failures(ext),
+        }
+
+    def phase(before: Dict, **report) -> Dict:
+        after = snapshot()
+        seconds = after["time"] - before["time"]
+        return {
+            "seconds": seconds,
+            "transactions": after["transactions"] - before["transactions"],
+            "lock_waits": after["lock_waits"] - before["lock_waits"],
+            "cas_failures": {
+                table: failures - before["cas_failures"].get(table, 0)
+                for table, failures in after["cas_failures"].items()
+                if failures != before["cas_failures"].get(table, 0)
+            },
+            **report,
+        }
+
+    bought = 0
+
+    async def buyer(task: int) -> None:
+        nonlocal bought
+        index = task
+        while True:
+            ticket = await buy_ticket(ext, competition, index)
+            if not ticket:
+                return
+            await crud.set_ticket_funded(ticket.id)
+            bought += 1
+            index += args.tasks
+
+    before = snapshot()
+    await asyncio.gather(*(buyer(task) for task in range(args.tasks)))
+    phases["purchases"] = phase(before, tickets=bought, per_second=bought / (snapshot()["time"] - before["time"]))
+
+    before = snapshot()
+    completed = await asyncio.gather(*(
+        crud.complete_competition(competition.id, 0, False) for _ in range(args.tasks)
+    ))
+    # One complete_competition wins, the others lose their compare-and-swap
+    phases["completion"] = phase(before, attempts=len(completed), won=sum(completed))
+    await settle(ext, timings, competition)
+
+    before = snapshot()
+    counts = {"claims": 0, "cas_attempts": 0}
+    await asyncio.gather(*(pay(ext, timings, counts) for _ in range(args.tasks)))
+    paid = await crud.get_state_competition_tickets(competition.id, ["WON_PAID"])
+    phases["payouts"] = phase(
+        before,
+        paid=len(paid),
+        claims=counts["claims"],
+        cas_attempts=counts["cas_attempts"],
+        # Attempts per ticket moved, 1.0 when no worker ever lost a compare-and-swap
+        amplification=counts["cas_attempts"] / len(paid) if paid else 0.0,
+    )
+    return {"tasks": args.tasks, **phases, "functions": timings.report()}
+
+
+async def bench_crud(args) -> Dict:
+    ext = load_extension()
+    db = await ext.reset(latency=args.db_latency)
+    wallet = ext.lightning.add_wallet()
+    start = time.perf_counter()
+    competitions = await seed(ext, wallet, args.competitions, args.tickets)
+    report = {
+        "parameters": vars(args),
+        "seed": {"competitions": args.competitions, "tickets": args.competitions * args.tickets, "seconds": time.perf_counter() - start},
+        "functions": await bench_functions(ext, args, competitions),
+    }
+    if args.tasks:
+        report["contention"] = await bench_contention(ext, args, wallet)
+    report["db"] = {"transactions": db.transactions, "lock_waits": db.lock_waits}
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--competitions", type=int, default=5, help="seeded competitions")
+    parser.add_argument("--tickets", type=int, default=1000, help="funded tickets per competition")
+    parser.add_argument("--repeat", type=int, default=200, help="calls per function")
+    parser.add_argument("--tasks", type=int, default=0, help="concurrent tasks on one competition, none if 0")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds per sql statement")
+    parser.add_argument("--output", help="file to write the json report to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    report = json.dumps(asyncio.run(bench_crud(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
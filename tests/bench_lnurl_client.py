@@ -0,0 +1,108 @@
+"""
+Benchmark of the shared, pooled http client of helpers.py against a client per request, as
+the lnurl calls were made before, over the payout of --winners winners. Every winner is paid
+at a lightning address of a stand-in lnurl server on a local port, by the payout workers.
+
+    python tests/bench_lnurl_client.py --winners 1000 --output lnurl.json
+
+Reports the connections the server accepted, each a tcp handshake (and a tls one in
+production), the requests it served and the payout duration, for both clients.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from loguru import logger
+
+from harness import Extension, FakeLnurlServer, encode_lnurl, load_extension
+
+
+async def unpooled_http_get(url: str) -> httpx.Response:
+    # A new client, and connection, per request
+    async with httpx.AsyncClient(timeout=10) as client:
+        return await client.get(url)
+
+
+async def pay_winners(ext: Extension, args, pooled: bool) -> Dict:
+    db = await ext.reset()
+    lnurl_server = FakeLnurlServer(ext.lightning, ext.lightning.add_wallet(), args.lnurl_latency)
+    server = await lnurl_server.serve()
+    host, port = server.sockets[0].getsockname()[:2]
+    http_get = ext.helpers.http_get
+    if not pooled:
+        ext.helpers.http_get = unpooled_http_get
+    wallet = ext.lightning.add_wallet()
+    competition = await ext.create_competition(wallet, amount_tickets=args.winners)
+    for index in range(args.winners):
+        await ext.fund_ticket(competition, 10, 0, encode_lnurl(f"http://{host}:{port}/.well-known/lnurlp/user{index}"))
+    assert await ext.crud.complete_competition(competition.id, 0, False)
+    await ext.tasks.settle_competition({"competition": competition.id, "enqueued": 0, "state": "RUNNING"}, 0, False)
+
+    start = time.perf_counter()
+    dispatcher = asyncio.create_task(ext.tasks.wait_for_reward_ticket_ids())
+    try:
+        while True:
+            row = await db.fetchone("SELECT state FROM bets4sats.competitions WHERE id = ?", (competition.id,))
+            if row["state"] == "COMPLETED_PAID":
+                break
+            if time.perf_counter() - start > args.timeout:
+                raise TimeoutError("Timed out")
+            await asyncio.sleep(0.05)
+        seconds = time.perf_counter() - start
+    finally:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        ext.helpers.http_get = http_get
+        await ext.helpers.close_http_client()
+        server.close()
+        await server.wait_closed()
+    paid = await ext.crud.get_state_competition_tickets(competition.id, ["WON_PAID"])
+    return {
+        "paid": len(paid),
+        "seconds": seconds,
+        "per_second": len(paid) / seconds if seconds else 0.0,
+        "requests": lnurl_server.requests,
+        "connections": lnurl_server.connections,
+    }
+
+
+async def bench_lnurl_client(args) -> Dict:
+    ext = load_extension()
+    pooled = await pay_winners(ext, args, pooled=True)
+    unpooled = await pay_winners(ext, args, pooled=False)
+    return {
+        "parameters": vars(args),
+        "pooled": pooled,
+        "unpooled": unpooled,
+        "handshakes_saved": unpooled["connections"] - pooled["connections"],
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--winners", type=int, default=1000)
+    parser.add_argument("--lnurl-latency", type=float, default=0.0, help="seconds per lnurl request")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for the payouts")
+    parser.add_argument("--output", help="file to write the json report to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    report = json.dumps(asyncio.run(bench_lnurl_client(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark of the serialization of ticket lists: the rows straight to json, as the list routes
+do, against a Ticket model per row encoded by FastAPI, as they did before. The tickets are
+inserted in the in-memory sqlite database of harness.py, --rows of them per run.
+
+    python tests/bench_serialization.py --rows 10000 100000 --output serialization.json
+
+Reports the duration and the peak memory allocated by each, measured apart as tracemalloc
+slows everything down, and the size of the json, gzipped or not.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from loguru import logger
+from starlette.responses import JSONResponse
+
+from harness import Extension, load_extension
+
+
+async def insert_tickets(ext: Extension, wallet: str, rows: int) -> None:
+    # Straight into the database, as only reading them is measured
+    competition = await ext.create_competition(wallet)
+    now = int(time.time())
+    ext.db.connection.executemany(
+        """
+        INSERT INTO bets4sats.tickets (id, wallet, competition, amount, reward_target, choice, state, reward_msat, reward_failure, reward_payment_hash, payment_hash, time, updated, reward_target_status, reward_target_error, payout_msat)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            (uuid.uuid4().hex[:22], wallet, competition.id, 1000 + index % 1000, f"user{index}@example.com", index % 2,
+             "WON_PAID", 990_000, "", uuid.uuid4().hex, uuid.uuid4().hex, now, now, "VALID", "", 990_000)
+            for index in range(rows)
+        ),
+    )
+
+
+def measure(serialize: Callable[[], bytes]) -> Dict:
+    start = time.perf_counter()
+    body = serialize()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        serialize()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak, "bytes": len(body)}
+
+
+async def bench_rows(ext: Extension, rows: int) -> Dict:
+    await ext.reset()
+    wallet = ext.lightning.add_wallet()
+    await insert_tickets(ext, wallet, rows)
+    start = time.perf_counter()
+    ticket_rows = await ext.crud.get_ticket_rows(wallet)
+    read_seconds = time.perf_counter() - start
+
+    def models() -> bytes:
+        return JSONResponse(jsonable_encoder([ext.models.Ticket(**row) for row in ticket_rows])).body
+
+    def rows_json() -> bytes:
+        return ext.views_api.dumps_json(ticket_rows)
+
+    row_path = measure(rows_json)
+    model_path = measure(models)
+    start = time.perf_counter()
+    gzipped = gzip.compress(rows_json(), ext.views_api.GZIP_LEVEL)
+    return {
+        "rows": len(ticket_rows),
+        "read_seconds": read_seconds,
+        "models": model_path,
+        "rows_json": row_path,
+        "speedup": model_path["seconds"] / row_path["seconds"] if row_path["seconds"] else 0.0,
+        "gzip": {"seconds": time.perf_counter() - start, "bytes": len(gzipped)},
+    }
+
+
+async def bench_serialization(args) -> Dict:
+    ext = load_extension()
+    return {
+        "parameters": vars(args),
+        "json_encoder": "orjson" if ext.views_api.orjson else "json",
+        "runs": [await bench_rows(ext, rows) for rows in args.rows],
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000], help="tickets listed, per run")
+    parser.add_argument("--output", help="file to write the json report to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    report = json.dumps(asyncio.run(bench_serialization(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import pytest
+
+from harness import Extension, load_extension, run
+
+
+@pytest.fixture
+def ext() -> Extension:
+    # A fresh database and caches for every test, the modules are loaded once
+    extension = load_extension()
+    run(extension.reset)
+    return extension
@@ -0,0 +1,552 @@
+"""
+Runs the extension outside of lnbits: the lnbits modules it imports are replaced by
+stand-ins, the database is an in-memory sqlite with the bets4sats schema attached, and
+invoices are created and paid by a fake lightning backend.
+
+Shared by the tests and by the benchmark scripts next to them.
+"""
+import asyncio
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import sqlite3
+import sys
+import time
+import types
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "bets4sats"
+SQLITE = "SQLITE"
+
+
+# DATABASE
+
+
+class Connection:
+    def __init__(self, database: "Database"):
+        self.database = database
+
+    async def execute(self, query: str, values: tuple = ()) -> sqlite3.Cursor:
+        if self.database.statements is not None:
+            self.database.statements.append((query, tuple(values)))
+        # A cursor per statement, so results keep their rowcount like lnbits' do
+        cursor = self.database.connection.execute(query, tuple(values))
+        # Let other tasks run, as a real driver would while waiting for the database
+        await asyncio.sleep(self.database.latency)
+        return cursor
+
+    async def fetchall(self, query: str, values: tuple = ()) -> List[dict]:
+        cursor = await self.execute(query, values)
+        columns = [column[0] for column in cursor.description or ()]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    async def fetchone(self, query: str, values: tuple = ()) -> Optional[dict]:
+        rows = await self.fetchall(query, values)
+        return rows[0] if rows else None
+
+
+class Database:
+    """
+    The part of lnbits.db.Database used by the extension. Like lnbits on sqlite, one
+    connection is shared and every transaction holds a lock, so they never interleave.
+    """
+
+    type = SQLITE
+    big_int = "INT"
+    timestamp_placeholder = "?"
+    timestamp_now = "(strftime('%s', 'now'))"
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency # seconds each statement yields to other tasks
+        self.statements: Optional[List[Tuple[str, tuple]]] = None # recorded when a list
+        self.transactions = 0
+        self.lock_waits = 0 # transactions that had to wait for another one
+        self.connection = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+        self.connection.execute("ATTACH DATABASE ':memory:' AS bets4sats")
+        self.lock = asyncio.Lock()
+
+    def datetime_to_timestamp(self, date) -> float:
+        return time.mktime(date.timetuple())
+
+    @asynccontextmanager
+    async def connect(self):
+        if self.lock.locked():
+            self.lock_waits += 1
+        async with self.lock:
+            self.transactions += 1
+            self.connection.execute("BEGIN")
+            try:
+                yield Connection(self)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+
+    async def execute(self, query: str, values: tuple = ()) -> sqlite3.Cursor:
+        async with self.connect() as conn:
+            return await conn.execute(query, values)
+
+    async def fetchall(self, query: str, values: tuple = ()) -> List[dict]:
+        async with self.connect() as conn:
+            return await conn.fetchall(query, values)
+
+    async def fetchone(self, query: str, values: tuple = ()) -> Optional[dict]:
+        async with self.connect() as conn:
+            return await conn.fetchone(query, values)
+
+    def explain(self, query: str, values: tuple = ()) -> List[str]:
+        # The details of sqlite's query plan, e.g. "SEARCH tickets USING INDEX ..."
+        rows = self.connection.execute("EXPLAIN QUERY PLAN " + query, values).fetchall()
+        return [row[-1] for row in rows]
+
+
+# LIGHTNING
+
+
+@dataclass
+class Payment:
+    payment_hash: str
+    wallet_id: str
+    amount: int # msat, negative for outgoing payments
+    memo: str
+    bolt11: str
+    extra: Dict = field(default_factory=dict)
+    pending: bool = True
+
+    async def check_status(self) -> None:
+        return None
+
+
+@dataclass
+class DecodedInvoice:
+    payment_hash: str
+    amount_msat: int
+
+
+class FakeLightning:
+    """
+    Invoices and payments kept in memory. Invoices are paid with pay_ticket_invoice,
+    which notifies the invoice listeners like lnbits does, and outgoing payments
+    settle at once after `pay_latency` seconds.
+    """
+
+    def __init__(self, pay_latency: float = 0):
+        self.pay_latency = pay_latency
+        self.payments: Dict[str, Payment] = {}
+        self.wallets: Dict[str, str] = {} # wallet id -> user id
+        self.listeners: List[asyncio.Queue] = []
+
+    def add_wallet(self, user: str = "user") -> str:
+        wallet_id = uuid.uuid4().hex
+        self.wallets[wallet_id] = user
+        return wallet_id
+
+    async def create_invoice(
+        self, wallet_id: str, amount: int, memo: str, extra: Optional[Dict] = None, **kwargs
+    ) -> Tuple[str, str]:
+        return self.add_invoice(wallet_id, amount * 1000, memo, extra)
+
+    def add_invoice(
+        self, wallet_id: str, amount_msat: int, memo: str = "", extra: Optional[Dict] = None
+    ) -> Tuple[str, str]:
+        payment_hash = hashlib.sha256(uuid.uuid4().bytes).hexdigest()
+        bolt11 = f"lnfake{amount_msat}x{payment_hash}"
+        self.payments[payment_hash] = Payment(
+            payment_hash, wallet_id, amount_msat, memo, bolt11, extra or {}
+        )
+        return payment_hash, bolt11
+
+    def pay_ticket_invoice(self, payment_hash: str) -> Payment:
+        payment = self.payments[payment_hash]
+        payment.pending = False
+        for queue in self.listeners:
+            queue.put_nowait(payment)
+        return payment
+
+    async def pay_invoice(
+        self, wallet_id: str, payment_request: str, description: str = "", extra: Optional[Dict] = None, **kwargs
+    ) -> str:
+        decoded = decode_bolt11(payment_request)
+        if self.pay_latency:
+            await asyncio.sleep(self.pay_latency)
+        invoice = self.payments.get(decoded.payment_hash)
+        if invoice:
+            invoice.pending = False
+        # Stored under its own key, as the invoice may be in the same node
+        self.payments["out:" + decoded.payment_hash] = Payment(
+            decoded.payment_hash, wallet_id, -decoded.amount_msat, description, payment_request,
+            extra or {}, pending=False,
+        )
+        return decoded.payment_hash
+
+    async def get_standalone_payment(
+        self, payment_hash: str, incoming: Optional[bool] = None, wallet_id: Optional[str] = None
+    ) -> Optional[Payment]:
+        payment = self.payments.get(payment_hash if incoming is not False else "out:" + payment_hash)
+        if payment and wallet_id and payment.wallet_id != wallet_id:
+            return None
+        return payment
+
+    async def get_payments(
+        self, wallet_id: Optional[str] = None, incoming: bool = False, outgoing: bool = False,
+        limit: Optional[int] = None, filters: Optional["Filters"] = None, **kwargs
+    ) -> List[Payment]:
+        memos = set()
+        for memo_filter in filters.filters if filters else []:
+            if memo_filter.field == "memo":
+                memos.update(memo_filter.values)
+        payments = [
+            payment for payment in self.payments.values()
+            if (wallet_id is None or payment.wallet_id == wallet_id)
+            and (not incoming or payment.amount > 0)
+            and (not outgoing or payment.amount < 0)
+            and (not memos or payment.memo in memos)
+        ]
+        return payments[:limit] if limit else payments
+
+    async def get_wallet(self, wallet_id: str) -> Optional[types.SimpleNamespace]:
+        if wallet_id not in self.wallets:
+            return None
+        return types.SimpleNamespace(id=wallet_id, user=self.wallets[wallet_id], adminkey=wallet_id, inkey=wallet_id)
+
+    async def get_user(self, user_id: str) -> Optional[types.SimpleNamespace]:
+        wallet_ids = [wallet_id for wallet_id, user in self.wallets.items() if user == user_id]
+        return types.SimpleNamespace(id=user_id, wallet_ids=wallet_ids, admin=True) if wallet_ids else None
+
+    def register_invoice_listener(self, queue: asyncio.Queue, name: Optional[str] = None) -> None:
+        self.listeners.append(queue)
+
+
+def decode_bolt11(payment_request: str) -> DecodedInvoice:
+    if not payment_request.startswith("lnfake"):
+        raise ValueError("Not a fake invoice")
+    amount_msat, payment_hash = payment_request[len("lnfake"):].split("x", 1)
+    return DecodedInvoice(payment_hash, int(amount_msat))
+
+
+# Stands in for bech32 lnurls: any url, e.g. of a FakeLnurlServer on a local port
+LNURL_PREFIX = "lnurlfake"
+
+
+def encode_lnurl(url: str) -> str:
+    return LNURL_PREFIX + url.encode().hex()
+
+
+def decode_lnurl(code: str) -> str:
+    if not code.lower().startswith(LNURL_PREFIX):
+        raise ValueError("Not an lnurl")
+    return bytes.fromhex(code[len(LNURL_PREFIX):]).decode()
+
+
+def fee_reserve(amount_msat: int) -> int:
+    # lnbits' default: 1%, at least 2 sats
+    return max(2000, amount_msat // 100)
+
+
+class FakeLnurlServer:
+    """
+    Lightning-address endpoints for any name at any host, paying to `wallet` of `lightning`.
+    Serves httpx.MockTransport, or real connections with serve().
+    """
+
+    def __init__(self, lightning: FakeLightning, wallet: str, latency: float = 0):
+        self.lightning = lightning
+        self.wallet = wallet
+        self.latency = latency # seconds per request
+        self.requests = 0
+        self.connections = 0
+
+    async def handle(self, request: "httpx.Request") -> "httpx.Response":
+        import httpx
+
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = request.url.path
+        if path.startswith("/.well-known/lnurlp/"):
+            name = path.rsplit("/", 1)[1]
+            return httpx.Response(200, json={
+                "tag": "payRequest",
+                "minSendable": 1000,
+                "maxSendable": 10**15,
+                "callback": f"{request.url.scheme}://{request.url.netloc.decode()}/callback/{name}",
+                "commentAllowed": 255,
+            })
+        if path.startswith("/callback/"):
+            _, pr = self.lightning.add_invoice(self.wallet, int(request.url.params["amount"]))
+            return httpx.Response(200, json={"pr": pr, "routes": []})
+        return httpx.Response(404, json={"status": "ERROR"})
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.base_events.Server:
+        """
+        Serves plain http/1.1 with keep-alive on a local port, counting connections, as
+        reusing them is what a pooled client saves. Enough http for httpx, not more.
+        """
+        import httpx
+
+        async def connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            self.connections += 1
+            try:
+                while True:
+                    head = (await reader.readuntil(b"\r\n\r\n")).decode()
+                    request_line, *header_lines = head.strip().split("\r\n")
+                    method, target, _ = request_line.split(" ", 2)
+                    headers = dict(line.lower().split(": ", 1) for line in header_lines)
+                    request = httpx.Request(method, f"http://{headers['host']}{target}")
+                    response = await self.handle(request)
+                    body = response.content
+                    writer.write(
+                        f"HTTP/1.1 {response.status_code} OK\r\nContent-Type: application/json\r\n"
+                        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                    )
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(connection, host, port)
+
+
+# LNBITS STAND-INS
+
+
+class Filter:
+    def __init__(self, field: str, values: List[Any], model: Any = None, **kwargs):
+        self.field = field
+        self.values = values
+
+
+class Filters:
+    def __init__(self, filters: Optional[List[Filter]] = None, model: Any = None, **kwargs):
+        self.filters = filters or []
+
+
+def install_lnbits_stubs(lightning: FakeLightning) -> None:
+    """Registers stand-ins for the lnbits modules the extension imports, routed to `lightning`."""
+
+    def module(name: str, **attributes) -> types.ModuleType:
+        stub = types.ModuleType(name)
+        stub.__path__ = [] # importable as a package
+        stub.__dict__.update(attributes)
+        sys.modules[name] = stub
+        return stub
+
+    from fastapi import HTTPException, Request
+
+    async def get_key_type(request: Request) -> types.SimpleNamespace:
+        # The X-Api-Key is the wallet id
+        wallet = await lightning.get_wallet(request.headers.get("X-Api-Key", ""))
+        if wallet is None:
+            raise HTTPException(status_code=401, detail="Invalid key")
+        return types.SimpleNamespace(wallet_type=0, wallet=wallet)
+
+    async def check_user_exists(request: Request) -> types.SimpleNamespace:
+        return types.SimpleNamespace(id="user", wallet_ids=list(lightning.wallets), admin=True)
+
+    async def catch_everything_and_restart(function):
+        await function()
+
+    lnbits = module("lnbits")
+    lnbits.db = module("lnbits.db", Database=Database, SQLITE=SQLITE, POSTGRES="POSTGRES", COCKROACH="COCKROACH", Filters=Filters, Filter=Filter)
+    lnbits.helpers = module(
+        "lnbits.helpers",
+        urlsafe_short_hash=lambda: uuid.uuid4().hex,
+        template_renderer=lambda *args, **kwargs: None,
+        get_current_extension_name=lambda: PACKAGE,
+    )
+    lnbits.tasks = module(
+        "lnbits.tasks",
+        register_invoice_listener=lightning.register_invoice_listener,
+        catch_everything_and_restart=catch_everything_and_restart,
+    )
+    lnbits.core = module("lnbits.core")
+    lnbits.core.crud = module(
+        "lnbits.core.crud",
+        get_payments=lightning.get_payments,
+        get_standalone_payment=lightning.get_standalone_payment,
+        get_wallet=lightning.get_wallet,
+        get_user=lightning.get_user,
+    )
+    lnbits.core.models = module("lnbits.core.models", Payment=Payment, PaymentFilters=object, User=types.SimpleNamespace)
+    lnbits.core.services = module(
+        "lnbits.core.services",
+        create_invoice=lightning.create_invoice,
+        pay_invoice=lightning.pay_invoice,
+        fee_reserve=fee_reserve,
+    )
+    lnbits.lnurl = module("lnbits.lnurl", decode=decode_lnurl)
+    lnbits.bolt11 = module("lnbits.bolt11", decode=decode_bolt11)
+    lnbits.decorators = module(
+        "lnbits.decorators",
+        WalletTypeInfo=types.SimpleNamespace,
+        check_admin=check_user_exists,
+        check_user_exists=check_user_exists,
+        get_key_type=get_key_type,
+    )
+
+
+# EXTENSION
+
+
+class FakeRenderer:
+    """
+    Stands in for lnbits' template renderer, as the templates extend those of an lnbits
+    checkout: a page is the json of its template name and context. Counts the renderings.
+    """
+
+    def __init__(self):
+        self.renders = 0
+
+    def TemplateResponse(self, name: str, context: Dict[str, Any]):
+        from starlette.responses import HTMLResponse
+
+        self.renders += 1
+        page = {"template": name, **{key: value for key, value in context.items() if key != "request"}}
+        return HTMLResponse(json.dumps(page, sort_keys=True, default=str))
+
+
+class Extension:
+    """The extension's modules, loaded against the stand-ins, and the fake backends they use."""
+
+    MODULES = ("cache", "metrics", "models", "migrations", "crud", "helpers", "tasks", "views", "views_api")
+
+    def __init__(self, lightning: FakeLightning):
+        from fastapi import APIRouter
+
+        self.lightning = lightning
+        install_lnbits_stubs(lightning)
+        # The package is assembled here instead of running its __init__, which mounts the
+        # static files and templates of an lnbits checkout
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        package.__package__ = PACKAGE
+        package.db = Database()
+        package.bets4sats_ext = APIRouter(prefix="/bets4sats", tags=["Bets4Sats"])
+        self.renderer = FakeRenderer()
+        package.bets4sats_renderer = lambda: self.renderer
+        sys.modules[PACKAGE] = package
+        self.package = package
+        for name in self.MODULES:
+            setattr(self, name, importlib.import_module(f"{PACKAGE}.{name}"))
+
+    @property
+    def db(self) -> Database:
+        return self.crud.db
+
+    async def reset(self, latency: float = 0) -> Database:
+        """Starts over with an empty, migrated database and empty in-process caches."""
+        db = Database(latency)
+        self.package.db = db
+        self.crud.db = db
+        self.crud.competition_cache.clear()
+        self.views.rendered_pages.clear()
+        self.helpers.lnurlp_cache.clear()
+        self.tasks.settlement_jobs.clear()
+        self.lightning.payments.clear()
+        self.lightning.listeners.clear()
+        self.reset_workers()
+        await migrate(self.migrations, db)
+        return db
+
+    def reset_workers(self) -> None:
+        """
+        Starts the background workers' state over. Its asyncio primitives are bound to the
+        event loop that first waits on them, and every run() has a loop of its own.
+        """
+        tasks, helpers = self.tasks, self.helpers
+        tasks.ticket_created_event = self.views_api.ticket_created_event = asyncio.Event()
+        tasks.payout_wakeup_event = asyncio.Event()
+        tasks.payout_slots = asyncio.Semaphore(tasks.PAYOUT_WORKERS)
+        tasks.payout_host_slots = helpers.HostSlots(tasks.PAYOUT_HOST_WORKERS)
+        tasks.payouts_resumed = False
+        tasks.payouts_in_flight.clear()
+        tasks.tickets_paying.clear()
+        tasks.ticket_paid_subscribers.clear()
+        tasks.settlement_tasks.clear()
+        tasks.payout_stats.update(in_flight=0, completed=0, latency_sum=0.0, latency_max=0.0)
+        tasks.payout_latencies.clear()
+        helpers.http_client = None
+        helpers.http_host_slots = helpers.HostSlots(helpers.LNURL_HOST_CONNECTIONS)
+        helpers.lnurlp_lookups.clear()
+        self.metrics.counters.clear()
+        self.metrics.histograms.clear()
+
+    def app(self):
+        from fastapi import FastAPI
+
+        app = FastAPI()
+        app.include_router(self.package.bets4sats_ext)
+        return app
+
+    async def create_competition(
+        self, wallet: str, choices: int = 2, amount_tickets: int = 1000, **fields
+    ):
+        data = self.models.CreateCompetition(
+            wallet=wallet,
+            name=fields.pop("name", "competition"),
+            info=fields.pop("info", ""),
+            banner=fields.pop("banner", ""),
+            closing_datetime=fields.pop("closing_datetime", "2100-01-01T00:00:00.000Z"),
+            amount_tickets=amount_tickets,
+            min_bet=fields.pop("min_bet", 1),
+            max_bet=fields.pop("max_bet", 1_000_000),
+            choices=json.dumps([{"title": f"choice {index}"} for index in range(choices)]),
+            **fields,
+        )
+        return await self.crud.create_competition(data)
+
+    async def create_ticket(self, competition, amount: int, choice: int, reward_target: str = ""):
+        # As api_ticket_make_ticket does, without the checks
+        ticket_id = uuid.uuid4().hex[:22]
+        payment_hash, _ = await self.lightning.create_invoice(
+            competition.wallet, amount, f"Bets4SatsTicketId:{competition.id}.{ticket_id}",
+            {"tag": "bets4sats", "reward_target": reward_target, "choice": choice},
+        )
+        return await self.crud.create_ticket(
+            ticket_id=ticket_id,
+            wallet=competition.wallet,
+            competition=competition.id,
+            amount=amount,
+            reward_target=reward_target,
+            choice=choice,
+            payment_hash=payment_hash,
+        )
+
+    async def fund_ticket(self, competition, amount: int, choice: int, reward_target: str = ""):
+        ticket = await self.create_ticket(competition, amount, choice, reward_target)
+        assert ticket, "Competition closed for new tickets"
+        await self.crud.set_ticket_funded(ticket.id)
+        return await self.crud.get_ticket(ticket.id)
+
+
+async def migrate(migrations: types.ModuleType, db: Database) -> None:
+    # In version order, as lnbits runs them
+    steps = sorted(
+        (name, function) for name, function in inspect.getmembers(migrations, inspect.iscoroutinefunction)
+        if name.startswith("m") and name[1:4].isdigit()
+    )
+    for _, step in steps:
+        await step(db)
+
+
+_extension: Optional[Extension] = None
+
+
+def load_extension() -> Extension:
+    # Loaded once per process, as its modules hold process-wide state like lnbits does
+    global _extension
+    if _extension is None:
+        _extension = Extension(FakeLightning())
+    return _extension
+
+
+def run(coroutine: Callable[[], Awaitable[Any]]) -> Any:
+    return asyncio.run(coroutine())
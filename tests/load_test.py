@@ -0,0 +1,198 @@
+"""
+Load test of a competition's whole lifecycle, through the api routes and the background
+workers, against the stand-ins of harness.py: tickets are bought and paid concurrently,
+then the competition is completed and every winner paid over lnurl.
+
+    python tests/load_test.py --tickets 50000 --concurrency 100 --output load.json
+
+Reports purchases per second, p50/p99 latencies, settlement and payout durations, and the
+compare-and-swap updates that lost. Like lnbits on sqlite, transactions run one at a time,
+so --db-latency bounds the throughput of every phase.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from loguru import logger
+
+from harness import FakeLnurlServer, decode_bolt11, load_extension
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+    return {
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+        "max": latencies[-1],
+    }
+
+
+def cas_failures(ext) -> Dict[str, float]:
+    series = ext.metrics.counters.get("bets4sats_cas_failures_total", {})
+    return {dict(labels).get("table", ""): value for labels, value in series.items()}
+
+
+async def wait_until(condition, timeout: float, interval: float = 0.05) -> None:
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out")
+        await asyncio.sleep(interval)
+
+
+async def load_test(args) -> Dict:
+    ext = load_extension()
+    db = await ext.reset(latency=args.db_latency)
+    ext.lightning.pay_latency = args.pay_latency
+    wallet = ext.lightning.add_wallet()
+    lnurl_server = FakeLnurlServer(ext.lightning, ext.lightning.add_wallet(), args.lnurl_latency)
+    ext.helpers.http_client = httpx.AsyncClient(transport=httpx.MockTransport(lnurl_server.handle))
+    workers = [
+        asyncio.create_task(ext.tasks.wait_for_paid_invoices()),
+        asyncio.create_task(ext.tasks.wait_for_reward_ticket_ids()),
+    ]
+    api = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=ext.app()), base_url="http://bets4sats", headers={"X-Api-Key": wallet}
+    )
+    try:
+        response = await api.post("/bets4sats/api/v1/competitions", json={
+            "wallet": wallet,
+            "name": "load test",
+            "info": "",
+            "banner": "",
+            "closing_datetime": "2100-01-01T00:00:00.000Z",
+            "amount_tickets": args.tickets,
+            "min_bet": 1,
+            "max_bet": 1_000_000,
+            "choices": json.dumps([{"title": f"choice {index}"} for index in range(args.choices)]),
+        })
+        response.raise_for_status()
+        competition_id = response.json()["id"]
+
+        purchase_latencies: List[float] = []
+        funding_latencies: List[float] = []
+        failures = 0
+        next_ticket = 0
+
+        async def buyer() -> None:
+            nonlocal failures, next_ticket
+            while next_ticket < args.tickets:
+                index = next_ticket
+                next_ticket += 1
+                start = time.perf_counter()
+                response = await api.post(f"/bets4sats/api/v1/tickets/{competition_id}", json={
+                    "reward_target": f"user{index % args.reward_targets}@host{index % args.hosts}.load.test",
+                    "amount": 1000 + index % 1000,
+                    "choice": index % args.choices,
+                })
+                purchase_latencies.append(time.perf_counter() - start)
+                if response.is_error:
+                    failures += 1
+                    continue
+                ticket = response.json()
+                # Subscribed before paying, as the registration page's sse does
+                paid = ext.tasks.subscribe_ticket_paid(ticket["ticket_id"])
+                start = time.perf_counter()
+                ext.lightning.pay_ticket_invoice(decode_bolt11(ticket["payment_request"]).payment_hash)
+                await paid.get()
+                funding_latencies.append(time.perf_counter() - start)
+                ext.tasks.unsubscribe_ticket_paid(ticket["ticket_id"], paid)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(buyer() for _ in range(args.concurrency)))
+        purchase_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = await api.post(f"/bets4sats/api/v1/competitions/{competition_id}/complete", json={
+            "winning_choice": 0, "aggregate_payouts": args.aggregate,
+        })
+        response.raise_for_status()
+
+        async def settled() -> bool:
+            response = await api.get(f"/bets4sats/api/v1/competitions/{competition_id}/settlement")
+            settlement = response.json()
+            if settlement["state"] == "FAILED":
+                raise RuntimeError(settlement["error"])
+            return settlement["state"] == "DONE"
+
+        await wait_until(settled, args.timeout)
+        settlement_seconds = time.perf_counter() - start
+        settlement = (await api.get(f"/bets4sats/api/v1/competitions/{competition_id}/settlement")).json()
+
+        async def paid() -> bool:
+            # From the database, as get_competition may serve it from the cache
+            row = await db.fetchone("SELECT state FROM bets4sats.competitions WHERE id = ?", (competition_id,))
+            return row["state"] == "COMPLETED_PAID"
+
+        await wait_until(paid, args.timeout)
+        payout_seconds = time.perf_counter() - start - settlement_seconds
+        tickets = await ext.crud.get_ticket_counts(wallet)
+        payout_stats = await ext.tasks.get_payout_stats()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await api.aclose()
+        await ext.helpers.close_http_client()
+
+    funded = len(funding_latencies)
+    return {
+        "parameters": vars(args),
+        "purchases": {
+            "funded": funded,
+            "failed": failures,
+            "seconds": purchase_seconds,
+            "per_second": funded / purchase_seconds if purchase_seconds else 0.0,
+            "latency": percentiles(purchase_latencies),
+            "funding_latency": percentiles(funding_latencies),
+        },
+        "settlement": {"seconds": settlement_seconds, "payouts": settlement["enqueued"]},
+        "payouts": {
+            "seconds": payout_seconds,
+            "per_second": settlement["enqueued"] / payout_seconds if payout_seconds else 0.0,
+            "latency": {"p50": payout_stats["latency_p50"], "max": payout_stats["latency_max"]},
+            "lnurl_requests": lnurl_server.requests,
+        },
+        "tickets": {count.state: count.tickets for count in tickets},
+        "cas_failures": cas_failures(ext),
+        "db": {"transactions": db.transactions, "lock_waits": db.lock_waits},
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tickets", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent buyers")
+    parser.add_argument("--choices", type=int, default=2)
+    parser.add_argument("--reward-targets", type=int, default=500, help="distinct lightning addresses")
+    parser.add_argument("--hosts", type=int, default=10, help="lnurl hosts of the reward targets, each paid by PAYOUT_HOST_WORKERS at most")
+    parser.add_argument("--aggregate", action="store_true", help="one payment per reward target")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds per sql statement")
+    parser.add_argument("--pay-latency", type=float, default=0.0, help="seconds per outgoing payment")
+    parser.add_argument("--lnurl-latency", type=float, default=0.0, help="seconds per lnurl request")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for settlement and payouts")
+    parser.add_argument("--output", help="file to write the json report to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    report = json.dumps(asyncio.run(load_test(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
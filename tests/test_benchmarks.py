@@ -0,0 +1,38 @@
+from bench_crud import bench_crud, parse_args as parse_crud_args
+from bench_lnurl_client import bench_lnurl_client, parse_args as parse_lnurl_client_args
+from bench_serialization import bench_serialization, parse_args as parse_serialization_args
+from harness import run
+
+
+def test_bench_crud_measures_every_function_and_the_contention(ext):
+    args = parse_crud_args(["--competitions", "2", "--tickets", "20", "--repeat", "5", "--tasks", "4"])
+    report = run(lambda: bench_crud(args))
+
+    functions = report["functions"]
+    for name in ("create_ticket", "set_ticket_funded", "purge_expired_tickets", "update_competition_winners", "get_state_competition_tickets"):
+        assert functions[name]["calls"] and functions[name]["statements"]
+    contention = report["contention"]
+    assert contention["purchases"]["tickets"] == 20
+    assert contention["completion"]["won"] == 1
+    assert contention["completion"]["cas_failures"] == {"competitions": 3}
+    assert contention["payouts"]["paid"] == 10
+
+
+def test_bench_lnurl_client_reuses_connections_when_pooled(ext):
+    report = run(lambda: bench_lnurl_client(parse_lnurl_client_args(["--winners", "20"])))
+
+    pooled, unpooled = report["pooled"], report["unpooled"]
+    assert pooled["paid"] == unpooled["paid"] == 20
+    # Two lnurl requests per winner, over the connections the pool keeps to the host
+    assert pooled["requests"] == unpooled["requests"] == 40
+    assert pooled["connections"] <= ext.helpers.LNURL_HOST_CONNECTIONS
+    assert unpooled["connections"] == 40
+
+
+def test_bench_serialization_compares_the_same_json(ext):
+    report = run(lambda: bench_serialization(parse_serialization_args(["--rows", "10", "50"])))
+
+    assert [run["rows"] for run in report["runs"]] == [10, 50]
+    for rows_run in report["runs"]:
+        assert rows_run["models"]["bytes"] == rows_run["rows_json"]["bytes"]
+        assert rows_run["models"]["peak_bytes"] and rows_run["rows_json"]["peak_bytes"]
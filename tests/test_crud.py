@@ -0,0 +1,311 @@
+import json
+import time
+
+from harness import migrate, run
+
+
+async def choice_totals(ext, competition_id):
+    competition = await ext.crud.get_competition(competition_id)
+    return [(choice["total"], choice["sold"]) for choice in json.loads(competition.choices)]
+
+
+async def recounted_tickets(ext, competition_id):
+    # ticket_counts as recomputed from the tickets, to compare with the maintained counters
+    rows = await ext.db.fetchall(
+        """
+        SELECT state, COUNT(*) tickets, SUM(amount) amount, SUM(reward_msat) reward_msat
+        FROM bets4sats.tickets WHERE competition = ? GROUP BY state
+        """,
+        (competition_id,),
+    )
+    return {row["state"]: (row["tickets"], row["amount"], row["reward_msat"]) for row in rows}
+
+
+async def counted_tickets(ext, competition_id):
+    rows = await ext.db.fetchall(
+        "SELECT * FROM bets4sats.ticket_counts WHERE competition = ? AND tickets != 0",
+        (competition_id,),
+    )
+    return {row["state"]: (row["tickets"], row["amount"], row["reward_msat"]) for row in rows}
+
+
+def test_set_ticket_funded_counts_a_ticket_once(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        ticket = await ext.create_ticket(competition, 100, 1)
+        await ext.crud.set_ticket_funded(ticket.id)
+        await ext.crud.set_ticket_funded(ticket.id)
+
+        assert (await ext.crud.get_ticket(ticket.id)).state == "FUNDED"
+        assert (await ext.crud.get_competition(competition.id)).sold == 1
+        assert await choice_totals(ext, competition.id) == [(0, 0), (100, 1)]
+        assert await counted_tickets(ext, competition.id) == await recounted_tickets(ext, competition.id)
+
+    run(scenario)
+
+
+def test_cas_ticket_state_only_moves_from_the_expected_state(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        ticket = await ext.fund_ticket(competition, 100, 0)
+
+        assert not await ext.crud.cas_ticket_state(ticket.id, "INITIAL", "LOST")
+        assert await ext.crud.cas_ticket_state(ticket.id, "FUNDED", "WON_PAYING")
+        assert not await ext.crud.cas_ticket_state(ticket.id, "FUNDED", "WON_PAYING")
+        assert (await ext.crud.get_ticket(ticket.id)).state == "WON_PAYING"
+        assert await counted_tickets(ext, competition.id) == await recounted_tickets(ext, competition.id)
+
+    run(scenario)
+
+
+def test_finish_ticket_payout_counts_off_outstanding_payouts_once(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        ticket = await ext.fund_ticket(competition, 100, 0)
+        assert await ext.crud.complete_competition(competition.id, -1, False)
+        await ext.crud.update_competition_winners(competition.id, competition.choices, -1)
+        assert (await ext.crud.get_competition(competition.id)).outstanding_payouts == 1
+        assert await ext.crud.cas_ticket_state(ticket.id, "CANCELLED_UNPAID", "CANCELLED_PAYING")
+
+        for _ in range(2):
+            await ext.crud.finish_ticket_payout(ticket.id, "CANCELLED_PAYING", "CANCELLED_PAID", reward_msat=100_000)
+
+        assert (await ext.crud.get_competition(competition.id)).outstanding_payouts == 0
+        assert await ext.crud.is_competition_payment_complete(competition.id)
+        assert await counted_tickets(ext, competition.id) == await recounted_tickets(ext, competition.id)
+
+    run(scenario)
+
+
+def test_create_ticket_stops_when_sold_out(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet, amount_tickets=2)
+
+        assert await ext.create_ticket(competition, 100, 0)
+        assert await ext.create_ticket(competition, 100, 1)
+        assert await ext.create_ticket(competition, 100, 1) is None
+        assert (await ext.crud.get_competition(competition.id)).amount_tickets == 0
+
+    run(scenario)
+
+
+def test_create_ticket_stops_when_completed(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        await ext.fund_ticket(competition, 100, 0)
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+
+        assert await ext.create_ticket(competition, 100, 0) is None
+        assert not await ext.crud.complete_competition(competition.id, 1, False)
+
+    run(scenario)
+
+
+def test_ticket_funded_after_completion_is_refunded(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        await ext.fund_ticket(competition, 100, 0)
+        late_ticket = await ext.create_ticket(competition, 50, 0)
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+
+        await ext.crud.set_ticket_funded(late_ticket.id)
+
+        late_ticket = await ext.crud.get_ticket(late_ticket.id)
+        assert late_ticket.state == "CANCELLED_UNPAID"
+        assert late_ticket.payout_msat == 50_000
+        assert await choice_totals(ext, competition.id) == [(100, 1), (0, 0)]
+        assert [payout.ticket for payout in await ext.crud.claim_payouts(10)] == [late_ticket.id]
+        assert (await ext.crud.get_competition(competition.id)).outstanding_payouts == 1
+        assert await counted_tickets(ext, competition.id) == await recounted_tickets(ext, competition.id)
+
+    run(scenario)
+
+
+def test_purge_expired_tickets_gives_the_tickets_back(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet, amount_tickets=10)
+        expired = await ext.create_ticket(competition, 100, 0)
+        funded = await ext.fund_ticket(competition, 100, 0)
+        await ext.db.execute(
+            "UPDATE bets4sats.tickets SET time = time - ? WHERE id IN (?, ?)",
+            (ext.crud.TICKET_PURGE_TIME + 60, expired.id, funded.id),
+        )
+
+        assert await ext.crud.purge_expired_tickets() == 1
+
+        assert await ext.crud.get_ticket(expired.id) is None
+        assert (await ext.crud.get_ticket(funded.id)).state == "FUNDED"
+        assert (await ext.crud.get_competition(competition.id)).amount_tickets == 9
+        assert await counted_tickets(ext, competition.id) == await recounted_tickets(ext, competition.id)
+
+    run(scenario)
+
+
+def test_sum_choices_amounts_leaves_out_unpaid_and_late_tickets(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet, choices=3)
+        await ext.fund_ticket(competition, 100, 0)
+        await ext.fund_ticket(competition, 20, 0)
+        await ext.fund_ticket(competition, 300, 2)
+        await ext.create_ticket(competition, 1000, 1)
+        late_ticket = await ext.create_ticket(competition, 5000, 2)
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+        await ext.crud.set_ticket_funded(late_ticket.id)
+
+        sums = await ext.crud.sum_choices_amounts(competition.id, include_cancelled=False)
+        assert {row.choice: row.amount_sum for row in sums} == {0: 120, 2: 300}
+        sums = await ext.crud.sum_choices_amounts(competition.id)
+        assert {row.choice: row.amount_sum for row in sums} == {0: 120, 2: 5300}
+
+    run(scenario)
+
+
+def test_settled_payouts_add_up_to_the_prize_pool(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet, choices=3)
+        for amount, choice in [(7, 0), (11, 0), (13, 0), (100, 1), (3, 2)]:
+            await ext.fund_ticket(competition, amount, choice)
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+        competition = await ext.crud.get_competition(competition.id)
+        prize_pool_msat = 134_000 * 99 // 100
+
+        await ext.crud.update_competition_winners(competition.id, competition.choices, 0)
+        for _ in range(2):
+            await ext.crud.set_ticket_payouts(competition.id, prize_pool_msat, 31)
+
+        tickets = await ext.crud.get_state_competition_tickets(competition.id, ["WON_UNPAID"])
+        assert sorted(ticket.amount for ticket in tickets) == [7, 11, 13]
+        assert sum(ticket.payout_msat for ticket in tickets) == prize_pool_msat
+        assert len(await ext.crud.get_state_competition_tickets(competition.id, ["LOST"])) == 2
+        assert (await ext.crud.get_competition(competition.id)).outstanding_payouts == 3
+        assert await counted_tickets(ext, competition.id) == await recounted_tickets(ext, competition.id)
+
+    run(scenario)
+
+
+def test_m003_backfills_choice_totals_from_funded_tickets(ext):
+    async def scenario():
+        db = ext.db.__class__()
+        await ext.migrations.m001_initial(db)
+        await ext.migrations.m002_changed(db)
+        await db.execute(
+            """
+            INSERT INTO bets4sats.competitions (id, wallet, register_id, name, info, banner, closing_datetime, amount_tickets, min_bet, max_bet, sold, choices, winning_choice, state)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            # Totals lost an update, as concurrent fundings rewrote the json
+            ("competition", "wallet", "register", "", "", "", "", 10, 1, 1000, 3, json.dumps([{"title": "a", "total": 5}, {"title": "b", "total": 0}]), -1, "INITIAL"),
+        )
+        for ticket_id, amount, choice, state in [("1", 5, 0, "FUNDED"), ("2", 7, 0, "FUNDED"), ("3", 9, 0, "INITIAL"), ("4", 11, 1, "WON_PAID")]:
+            await db.execute(
+                """
+                INSERT INTO bets4sats.tickets (id, wallet, competition, amount, reward_target, choice, state, reward_msat, reward_failure, reward_payment_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (ticket_id, "wallet", "competition", amount, "", choice, state, 0, "", ""),
+            )
+
+        await ext.migrations.m003_choices(db)
+
+        rows = await db.fetchall("SELECT choice, total, sold FROM bets4sats.choices ORDER BY choice")
+        assert [(row["total"], row["sold"]) for row in rows] == [(12, 2), (11, 1)]
+
+    run(scenario)
+
+
+def test_migrations_run_on_an_empty_database(ext):
+    async def scenario():
+        await migrate(ext.migrations, ext.db.__class__())
+
+    run(scenario)
+
+
+def test_purge_expired_tickets_purges_tickets_due_at_the_purge_time(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        ticket = await ext.create_ticket(competition, 100, 0)
+        await ext.db.execute(
+            "UPDATE bets4sats.tickets SET time = ? WHERE id = ?",
+            (int(time.time()) - ext.crud.TICKET_PURGE_TIME, ticket.id),
+        )
+        assert await ext.crud.get_next_ticket_purge_time() <= time.time()
+
+        assert await ext.crud.purge_expired_tickets() == 1
+        assert await ext.crud.get_next_ticket_purge_time() is None
+
+    run(scenario)
+
+
+def test_ticket_feed_reports_the_tickets_deleted_since(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        deleted = await ext.fund_ticket(competition, 100, 0)
+        expired = await ext.create_ticket(competition, 100, 0)
+        kept = await ext.fund_ticket(competition, 100, 1)
+        since = int(time.time())
+        await ext.db.execute(
+            "UPDATE bets4sats.tickets SET time = time - ? WHERE id = ?",
+            (ext.crud.TICKET_PURGE_TIME + 60, expired.id),
+        )
+
+        await ext.crud.delete_ticket(deleted.id)
+        assert await ext.crud.purge_expired_tickets() == 1
+
+        feed = await ext.crud.get_wallet_competition_ticket_rows(competition.id, since)
+        assert {row["id"] for row in feed if not row.get("deleted")} == {kept.id}
+        assert sorted(row["id"] for row in feed if row.get("deleted")) == sorted([deleted.id, expired.id])
+        assert all(row["updated"] >= since for row in feed)
+        assert not await ext.crud.get_wallet_competition_ticket_rows(competition.id, int(time.time()) + 1)
+        assert [row["id"] for row in await ext.crud.get_wallet_competition_ticket_rows(competition.id)] == [kept.id]
+
+        await ext.crud.delete_competition_tickets(competition.id)
+        assert not await ext.crud.get_wallet_competition_ticket_rows(competition.id, since)
+
+    run(scenario)
+
+
+def test_ticket_pages_of_several_wallets_are_merged_in_order(ext):
+    async def scenario():
+        wallets = [ext.lightning.add_wallet(), ext.lightning.add_wallet()]
+        for index in range(7):
+            competition = await ext.create_competition(wallets[index % 2])
+            ticket = await ext.create_ticket(competition, 100, 0)
+            await ext.db.execute("UPDATE bets4sats.tickets SET time = ? WHERE id = ?", (1000 + index // 3, ticket.id))
+        everything = await ext.crud.get_ticket_rows(wallets)
+        assert [(row["time"], row["id"]) for row in everything] == sorted((row["time"], row["id"]) for row in everything)
+
+        pages = []
+        after = None
+        while True:
+            page = await ext.crud.get_ticket_rows(wallets, 3, after)
+            if not page:
+                break
+            pages.extend(page)
+            after = (page[-1]["time"], page[-1]["id"])
+        assert pages == everything
+
+    run(scenario)
+
+
+def test_public_crud_functions_are_timed_and_private_helpers_are_not(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        await ext.fund_ticket(competition, 100, 0)
+
+        timed = {dict(labels)["function"] for labels in ext.metrics.histograms[ext.crud.CRUD_SECONDS]}
+        assert {"create_competition", "create_ticket", "set_ticket_funded", "get_ticket"} <= timed
+        assert not any(function.startswith("_") for function in timed)
+
+    run(scenario)
@@ -0,0 +1,15 @@
+from harness import run
+from load_test import load_test, parse_args
+
+
+def test_load_test_pays_every_winner(ext):
+    for aggregate in ([], ["--aggregate"]):
+        # All on one lnurl host, the busiest case for the payout workers
+        args = parse_args(["--tickets", "40", "--concurrency", "5", "--reward-targets", "7", "--hosts", "1", *aggregate])
+        report = run(lambda: load_test(args))
+
+        assert report["purchases"]["funded"] == 40
+        assert report["tickets"] == {"WON_PAID": 20, "LOST": 20}
+        # Even tickets win, paid to user{index % 7}@host0
+        winning_targets = {index % 7 for index in range(0, 40, 2)}
+        assert report["settlement"]["payouts"] == (len(winning_targets) if aggregate else 20)
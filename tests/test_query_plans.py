@@ -0,0 +1,102 @@
+import re
+
+from harness import run
+
+TABLE_SCAN = re.compile(r"^SCAN (bets4sats\.)?(\w+)$")
+TEMP_B_TREE = re.compile(r"^USE TEMP B-TREE FOR (.+)$")
+
+# Statements that read a whole table by design
+FULL_TABLE_READS = (
+    "SELECT COUNT(*) AS count FROM bets4sats.payouts", # outbox depth, on its smallest index
+)
+# Statements that sort or group a competition's tickets by design, once per settlement
+SETTLEMENT_AGGREGATES = (
+    "SELECT choice, SUM(amount) amount_sum FROM bets4sats.tickets", # prize pool by choice
+    "INSERT INTO bets4sats.ticket_counts", # recount of the tickets moved by the settlement
+    "INSERT INTO bets4sats.payouts", # aggregated payouts, one per reward target and outcome
+    "SELECT COUNT(DISTINCT reward_target) AS count", # aggregated payouts to enqueue
+)
+
+
+async def run_lifecycle(ext, winning_choice, aggregate):
+    # Every crud function the routes and workers use, on one competition
+    wallet = ext.lightning.add_wallet()
+    other_wallet = ext.lightning.add_wallet()
+    competition = await ext.create_competition(wallet, choices=2)
+    await ext.create_competition(other_wallet)
+    for index in range(20):
+        await ext.fund_ticket(competition, 100 + index, index % 2, f"user{index % 5}@example.com")
+    await ext.fund_ticket(competition, 10, 0)
+    unpaid = await ext.create_ticket(competition, 5, 0)
+    await ext.crud.get_next_ticket_purge_time()
+    await ext.crud.purge_expired_tickets()
+    await ext.crud.get_ticket_rows([wallet], 10, None)
+    await ext.crud.get_ticket_rows([wallet], 10, (0, ""))
+    await ext.crud.get_competition_rows([wallet], 10, (0, ""))
+    await ext.crud.get_ticket_rows([wallet, other_wallet], 10, (0, ""))
+    await ext.crud.get_competition_rows([wallet, other_wallet], 10, (0, ""))
+    await ext.crud.get_wallet_competition_ticket_rows(competition.id, 5)
+    await ext.crud.get_wallet_competition_ticket_rows(competition.id)
+    await ext.crud.get_ticket_counts([wallet])
+    await ext.crud.update_ticket(unpaid.id, reward_target_status="VALID")
+    assert await ext.crud.complete_competition(competition.id, winning_choice, aggregate)
+    await ext.crud.set_ticket_funded(unpaid.id)
+    await ext.crud.get_unsettled_competitions()
+    job = {"competition": competition.id, "enqueued": 0, "state": "RUNNING"}
+    await ext.tasks.settle_competition(job, winning_choice, aggregate)
+    assert job["state"] == "DONE"
+    await ext.crud.get_state_competition_tickets(competition.id, ["WON_UNPAID", "CANCELLED_UNPAID"])
+    await ext.crud.get_reward_target_tickets(competition.id, "user1@example.com", ["WON_UNPAID"])
+    payouts = await ext.crud.claim_payouts(10)
+    await ext.crud.release_payout_claims()
+    ticket = await ext.crud.get_ticket(payouts[0].ticket)
+    paying_state = ticket.state.replace("UNPAID", "PAYING")
+    assert await ext.crud.cas_ticket_state(ticket.id, ticket.state, paying_state)
+    assert await ext.crud.finish_ticket_payout(ticket.id, paying_state, paying_state.replace("PAYING", "PAID"))
+    await ext.crud.delete_payout(ticket.id)
+    await ext.crud.count_payouts()
+    await ext.crud.is_competition_payment_complete(competition.id)
+    await ext.crud.delete_ticket(ticket.id)
+    await ext.crud.delete_competition(competition.id)
+
+
+def assert_no_table_scans(db):
+    # Nor temporary sorts, e.g. of the rows of several wallets for a page
+    scans = []
+    for query, values in dict.fromkeys(db.statements):
+        statement = " ".join(query.split())
+        for detail in db.explain(query, values):
+            match = TABLE_SCAN.match(detail)
+            if match and not statement.startswith(FULL_TABLE_READS):
+                scans.append(f"{match.group(2)}: {statement}")
+            match = TEMP_B_TREE.match(detail)
+            if match and not statement.startswith(SETTLEMENT_AGGREGATES):
+                scans.append(f"temp b-tree for {match.group(1)}: {statement}")
+    assert not scans, "Table scans and sorts:\n" + "\n".join(scans)
+
+
+def test_won_competition_queries_use_indexes(ext):
+    async def scenario():
+        ext.db.statements = []
+        await run_lifecycle(ext, 0, False)
+        assert_no_table_scans(ext.db)
+
+    run(scenario)
+
+
+def test_aggregated_competition_queries_use_indexes(ext):
+    async def scenario():
+        ext.db.statements = []
+        await run_lifecycle(ext, 1, True)
+        assert_no_table_scans(ext.db)
+
+    run(scenario)
+
+
+def test_cancelled_competition_queries_use_indexes(ext):
+    async def scenario():
+        ext.db.statements = []
+        await run_lifecycle(ext, -1, False)
+        assert_no_table_scans(ext.db)
+
+    run(scenario)
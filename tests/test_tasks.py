@@ -0,0 +1,141 @@
+import asyncio
+
+from harness import run
+
+
+def test_split_reward_msat_gives_the_remainder_to_the_first_ticket(ext):
+    assert ext.tasks.split_reward_msat(1000, [1, 1, 1]) == [334, 333, 333]
+    assert ext.tasks.split_reward_msat(1000, [0, 0]) == [1000, 0]
+
+
+def test_aggregated_settlement_enqueues_every_reward_target(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        # Tickets may be bought without a reward target, they are paid too (and fail)
+        for amount, reward_target in [(10, ""), (20, "a@example.com"), (30, "a@example.com"), (40, "b@example.com")]:
+            await ext.fund_ticket(competition, amount, 0, reward_target)
+        assert await ext.crud.complete_competition(competition.id, 0, True)
+
+        job = {"competition": competition.id, "enqueued": 0, "state": "RUNNING"}
+        await ext.tasks.settle_competition(job, 0, True)
+
+        assert job["state"] == "DONE"
+        assert job["enqueued"] == job["total"] == 3
+        assert not await ext.crud.get_unsettled_competitions()
+
+    run(scenario)
+
+
+def test_unsettled_competitions_are_those_with_tickets_left_to_enqueue(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        await ext.fund_ticket(competition, 10, 0, "a@example.com")
+        await ext.fund_ticket(competition, 20, 0, "a@example.com")
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+        assert [row.id for row in await ext.crud.get_unsettled_competitions()] == [competition.id]
+
+        job = {"competition": competition.id, "enqueued": 0, "state": "RUNNING"}
+        await ext.tasks.settle_competition(job, 0, False)
+        assert not await ext.crud.get_unsettled_competitions()
+
+        await ext.crud.delete_payout((await ext.crud.claim_payouts(1))[0].ticket)
+        assert [row.id for row in await ext.crud.get_unsettled_competitions()] == [competition.id]
+
+    run(scenario)
+
+
+def test_aggregated_settlement_enqueues_winnings_of_a_reward_target_with_a_late_refund(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        winner = await ext.fund_ticket(competition, 10, 0, "a@example.com")
+        late_ticket = await ext.create_ticket(competition, 20, 0, "a@example.com")
+        assert await ext.crud.complete_competition(competition.id, 0, True)
+        # Refunded on its own payout, not an aggregate one
+        await ext.crud.set_ticket_funded(late_ticket.id)
+
+        job = {"competition": competition.id, "enqueued": 0, "state": "RUNNING"}
+        await ext.tasks.settle_competition(job, 0, True)
+
+        assert job["state"] == "DONE"
+        assert job["enqueued"] == job["total"] == 1
+        payouts = await ext.crud.claim_payouts(10)
+        assert sorted((payout.ticket, payout.aggregate) for payout in payouts) == sorted(
+            [(winner.id, True), (late_ticket.id, False)]
+        )
+        assert not await ext.crud.get_unsettled_competitions()
+
+    run(scenario)
+
+
+def test_payouts_to_a_busy_host_are_claimed_no_faster_than_workers_run_them(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        # All on one host, so at most PAYOUT_HOST_WORKERS of them are paid at once
+        tickets = [await ext.fund_ticket(competition, 10, 0, f"user{index}@example.com") for index in range(30)]
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+        await ext.tasks.settle_competition({"competition": competition.id, "enqueued": 0, "state": "RUNNING"}, 0, False)
+
+        paid = []
+        peak_tasks = 0
+
+        async def on_reward_ticket_id(ticket_id, aggregate):
+            nonlocal peak_tasks
+            peak_tasks = max(peak_tasks, len(ext.tasks.payouts_in_flight))
+            await asyncio.sleep(0.01)
+            paid.append(ticket_id)
+            return True
+
+        original = ext.tasks.on_reward_ticket_id
+        ext.tasks.on_reward_ticket_id = on_reward_ticket_id
+        dispatcher = asyncio.create_task(ext.tasks.wait_for_reward_ticket_ids())
+        try:
+            while await ext.crud.count_payouts():
+                await asyncio.sleep(0.01)
+        finally:
+            dispatcher.cancel()
+            ext.tasks.on_reward_ticket_id = original
+
+        assert peak_tasks <= ext.tasks.PAYOUT_WORKERS
+        assert sorted(paid) == sorted(ticket.id for ticket in tickets)
+
+    run(scenario)
+
+
+def test_refresh_payout_claim_needs_the_current_claim(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        await ext.fund_ticket(competition, 10, 0, "a@example.com")
+        assert await ext.crud.complete_competition(competition.id, 0, False)
+        await ext.tasks.settle_competition({"competition": competition.id, "enqueued": 0, "state": "RUNNING"}, 0, False)
+        payout, = await ext.crud.claim_payouts(1)
+
+        assert await ext.crud.refresh_payout_claim(payout.ticket, payout.claim)
+        await ext.crud.release_payout_claims()
+        assert not await ext.crud.refresh_payout_claim(payout.ticket, payout.claim)
+
+    run(scenario)
+
+
+def test_tickets_being_paid_by_this_process_are_not_recovered(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        late_ticket = await ext.create_ticket(competition, 20, 0, "a@example.com")
+        assert await ext.crud.complete_competition(competition.id, -1, False)
+        await ext.crud.set_ticket_funded(late_ticket.id)
+        # As when paid in an aggregated refund, keyed by another ticket, still fetching the invoice
+        assert await ext.crud.cas_ticket_state(late_ticket.id, "CANCELLED_UNPAID", "CANCELLED_PAYING")
+        ext.tasks.tickets_paying.add(late_ticket.id)
+        try:
+            assert not await ext.tasks.on_reward_ticket_id(late_ticket.id)
+        finally:
+            ext.tasks.tickets_paying.discard(late_ticket.id)
+
+        assert (await ext.crud.get_ticket(late_ticket.id)).state == "CANCELLED_PAYING"
+
+    run(scenario)
@@ -0,0 +1,82 @@
+import base64
+import json
+
+from harness import run
+from test_views_api import api_client
+
+
+def test_public_page_is_rendered_again_only_when_it_changed(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        page_url = f"/bets4sats/competitions/{competition.id}"
+
+        async with api_client(ext) as api:
+            response = await api.get(page_url)
+            assert response.status_code == 200
+            etag = response.headers["ETag"]
+            assert ext.renderer.renders == 1
+
+            response = await api.get(page_url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            response = await api.get(page_url)
+            assert response.status_code == 200 and response.headers["ETag"] == etag
+            assert ext.renderer.renders == 1
+
+            await ext.fund_ticket(competition, 100, 1)
+            response = await api.get(page_url, headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+            assert ext.renderer.renders == 2
+            page = response.json()
+            assert page["competition_amount_tickets"] == 999
+            assert [choice["total"] for choice in json.loads(page["competition_choices"])] == [0, 100]
+
+    run(scenario)
+
+
+def test_banner_is_served_as_an_immutable_image(ext):
+    async def scenario():
+        png = b"\x89PNG\r\n\x1a\n"
+        banner_hash = await ext.crud.create_banner("data:image/png;base64," + base64.b64encode(png).decode())
+
+        async with api_client(ext) as api:
+            response = await api.get(f"/bets4sats/banners/{banner_hash}")
+
+        assert response.status_code == 200
+        assert response.content == png
+        assert response.headers["Content-Type"] == "image/png"
+        assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+        assert response.headers["ETag"] == f'"{banner_hash}"'
+        assert response.headers["X-Content-Type-Options"] == "nosniff"
+        assert response.headers["Content-Security-Policy"] == "sandbox"
+
+    run(scenario)
+
+
+def test_banner_urls_are_redirected_to(ext):
+    async def scenario():
+        banner_hash = await ext.crud.create_banner("https://example.com/banner.png")
+
+        async with api_client(ext) as api:
+            response = await api.get(f"/bets4sats/banners/{banner_hash}")
+
+        assert response.status_code == 301
+        assert response.headers["Location"] == "https://example.com/banner.png"
+
+    run(scenario)
+
+
+def test_banners_other_than_images_are_not_found(ext):
+    async def scenario():
+        # Stored before banners were checked, e.g. a page that would run on the lnbits origin
+        html_hash = await ext.crud.create_banner("data:text/html,<script>alert(1)</script>")
+        svg_hash = await ext.crud.create_banner("data:image/svg+xml;base64," + base64.b64encode(b"<svg/>").decode())
+
+        async with api_client(ext) as api:
+            for banner_hash in (html_hash, svg_hash, "unknown"):
+                response = await api.get(f"/bets4sats/banners/{banner_hash}")
+                assert response.status_code == 404
+                assert response.headers["Content-Type"] == "application/json"
+
+    run(scenario)
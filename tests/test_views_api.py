@@ -0,0 +1,82 @@
+import json
+
+import httpx
+
+from harness import run
+
+
+def api_client(ext, wallet: str = "") -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=ext.app()), base_url="http://bets4sats", headers={"X-Api-Key": wallet}
+    )
+
+
+def model_json(model) -> dict:
+    # As FastAPI serializes the models the routes used to return
+    return json.loads(model.json())
+
+
+def assert_same_json(left, right) -> None:
+    # As text, since 1 == True in python but not in json
+    assert json.dumps(left, sort_keys=True) == json.dumps(right, sort_keys=True)
+
+
+def test_list_routes_serialize_rows_as_their_models_would(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet, choices=3)
+        for amount, choice in [(10, 0), (20, 1), (30, 0)]:
+            await ext.fund_ticket(competition, amount, choice, "a@example.com")
+        await ext.create_ticket(competition, 40, 2)
+        aggregated = await ext.create_competition(wallet)
+        await ext.fund_ticket(aggregated, 50, 1, "b@example.com")
+        assert await ext.crud.complete_competition(aggregated.id, 1, True)
+        await ext.tasks.settle_competition({"competition": aggregated.id, "enqueued": 0, "state": "RUNNING"}, 1, True)
+
+        async with api_client(ext, wallet) as api:
+            tickets = (await api.get("/bets4sats/api/v1/tickets")).json()
+            competitions = (await api.get("/bets4sats/api/v1/competitions")).json()
+            competition_tickets = (await api.get(
+                f"/bets4sats/api/v1/competitiontickets/{competition.id}/{competition.register_id}"
+            )).json()
+
+        assert len(tickets) == 5
+        assert_same_json(tickets, [model_json(await ext.crud.get_ticket(ticket["id"])) for ticket in tickets])
+        assert sorted(competition_tickets, key=lambda ticket: ticket["id"]) == sorted(
+            (ticket for ticket in tickets if ticket["competition"] == competition.id), key=lambda ticket: ticket["id"]
+        )
+        ext.crud.competition_cache.clear()
+        # With the choice totals of bets4sats.choices merged into the choices json
+        assert_same_json(competitions, [model_json(await ext.crud.get_competition(row["id"])) for row in competitions])
+        choices, = [row["choices"] for row in competitions if row["id"] == competition.id]
+        assert [choice["total"] for choice in json.loads(choices)] == [40, 20, 0]
+
+    run(scenario)
+
+
+def test_odds_are_not_modified_until_a_ticket_is_funded(ext):
+    async def scenario():
+        wallet = ext.lightning.add_wallet()
+        competition = await ext.create_competition(wallet)
+        await ext.fund_ticket(competition, 100, 0)
+        ticket = await ext.create_ticket(competition, 300, 1)
+        odds_url = f"/bets4sats/api/v1/competitions/{competition.id}/odds"
+
+        async with api_client(ext) as api:
+            response = await api.get(odds_url)
+            assert response.status_code == 200
+            etag = response.headers["ETag"]
+            assert [choice["total"] for choice in response.json()["choices"]] == [100, 0]
+
+            response = await api.get(odds_url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.headers["ETag"] == etag
+            assert not response.content
+
+            await ext.crud.set_ticket_funded(ticket.id)
+            response = await api.get(odds_url, headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+            assert [choice["total"] for choice in response.json()["choices"]] == [100, 300]
+
+    run(scenario)
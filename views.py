@@ -1,21 +1,53 @@
 import json
+import hashlib
 import hmac
+from typing import Dict, Tuple
 from datetime import datetime
 from http import HTTPStatus
 
 from fastapi import Depends, Request
 from fastapi.templating import Jinja2Templates
 from starlette.exceptions import HTTPException
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, RedirectResponse, Response
 
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 
 from . import bets4sats_ext, bets4sats_renderer
-from .crud import get_competition, get_ticket
+from .cache import LruTtlCache
+from .crud import get_banner, get_competition, get_ticket
+from .helpers import parse_banner_data_url
 
 templates = Jinja2Templates(directory="templates")
 
+RENDERED_PAGES_CACHE_SIZE = 1000
+RENDERED_PAGES_CACHE_TTL = 5 * 60
+
+# (version, body) of rendered public pages
+rendered_pages: LruTtlCache[Tuple[str, bytes]] = LruTtlCache(RENDERED_PAGES_CACHE_SIZE, RENDERED_PAGES_CACHE_TTL)
+
+# Banner urls contain the hash of the banner, so a response never goes stale
+BANNER_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def render_cached(request: Request, page_key: str, template: str, context: Dict) -> Response:
+    """
+    Render a public page, reusing the previous rendering while its context is unchanged,
+    and answering conditional requests for an unchanged page with 304 Not Modified.
+    """
+    version = hashlib.sha256(json.dumps(context, sort_keys=True).encode()).hexdigest()[:32]
+    headers = {"ETag": f'"{version}"', "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    cache_key = f"{page_key}:{request.base_url}"
+    cached = rendered_pages.get(cache_key)
+    if cached and cached[0] == version:
+        body = cached[1]
+    else:
+        body = bets4sats_renderer().TemplateResponse(template, {"request": request, **context}).body
+        rendered_pages.set(cache_key, (version, body))
+    return HTMLResponse(body, headers=headers)
+
 
 @bets4sats_ext.get("/", response_class=HTMLResponse)
 async def index(request: Request, user: User = Depends(check_user_exists)):
@@ -32,14 +64,15 @@ async def display(request: Request, competition_id):
             status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist."
         )
 
-    return bets4sats_renderer().TemplateResponse(
+    return render_cached(
+        request,
+        f"display:{competition_id}",
         "bets4sats/display.html",
         {
-            "request": request,
             "competition_id": competition_id,
             "competition_name": competition.name,
             "competition_info": competition.info,
-            "competition_banner": json.dumps(competition.banner),
+            "competition_banner": json.dumps(f"/bets4sats/banners/{competition.banner_hash}" if competition.banner_hash else ""),
             "competition_state": competition.state,
             "competition_closing_datetime": competition.closing_datetime,
             "competition_choices": competition.choices,
@@ -65,16 +98,19 @@ async def ticket(request: Request, ticket_id):
             status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist."
         )
 
-    return bets4sats_renderer().TemplateResponse(
+    return render_cached(
+        request,
+        f"ticket:{ticket_id}",
         "bets4sats/ticket.html",
         {
-            "request": request,
             "ticket_id": ticket_id,
             "ticket_amount": ticket.amount,
             "competition_name": competition.name,
             "competition_id": competition.id,
             "ticket_choice": json.loads(competition.choices)[ticket.choice]["title"],
             "ticket_state": ticket.state,
+            "ticket_reward_target_status": ticket.reward_target_status,
+            "ticket_reward_target_error": ticket.reward_target_error,
         },
     )
 
@@ -96,3 +132,25 @@ async def register(request: Request, competition_id, register_id):
             "register_id": competition.register_id,
         },
     )
+
+
+@bets4sats_ext.get("/banners/{banner_hash}")
+async def banner(banner_hash: str):
+    banner = await get_banner(banner_hash)
+    if banner is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Banner does not exist.")
+    headers = {
+        "Cache-Control": BANNER_CACHE_CONTROL,
+        "ETag": f'"{banner_hash}"',
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "sandbox",
+    }
+    if banner.startswith("data:"):
+        data_url = parse_banner_data_url(banner)
+        if data_url is None:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Banner is not a valid image.")
+        media_type, body = data_url
+        return Response(body, media_type=media_type, headers=headers)
+    if not banner.startswith(("https://", "http://")):
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Banner is not an http or data url.")
+    return RedirectResponse(banner, status_code=HTTPStatus.MOVED_PERMANENTLY, headers=headers)
@@ -1,44 +1,118 @@
 from http import HTTPStatus
+import asyncio
 from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
 import json
 import hmac
+import zlib
+import gzip
 
-from fastapi import Depends, Query
+from fastapi import Depends, Query, Request
 from loguru import logger
 import shortuuid
 from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 
-from lnbits.core.crud import get_user, create_ticket, INVOICE_EXPIRY
+from lnbits.core.crud import get_user
 from lnbits.core.services import create_invoice
-from lnbits.decorators import WalletTypeInfo, get_key_type
+from lnbits.core.models import User
+from lnbits.decorators import WalletTypeInfo, check_admin, get_key_type
 
-from . import bets4sats_ext
-from .tasks import reward_ticket_ids_queue
-from .helpers import get_lnurlp_parameters, send_ticket
+from . import bets4sats_ext, metrics
+from .tasks import PRIZE_FEE_PERCENT, settlement_jobs, start_settlement, ticket_created_event, subscribe_ticket_paid, unsubscribe_ticket_paid, get_payout_stats
+from .helpers import get_lnurlp_parameters, is_banner_valid, lnurlp_cache, is_reward_target_well_formed, send_ticket, verify_ticket_reward_target
 from .crud import (
-    cas_competition_state,
+    competition_cache,
+    INVOICE_EXPIRY,
+    complete_competition,
     create_competition,
+    create_ticket,
     delete_competition,
     delete_competition_tickets,
     delete_ticket,
     get_competition,
-    get_state_competition_tickets,
-    get_wallet_competition_tickets,
-    get_competitions,
+    get_wallet_competition_ticket_rows,
+    get_competition_rows,
     get_ticket,
-    get_tickets,
-    sum_choices_amounts,
+    get_ticket_counts,
+    get_ticket_rows,
     update_competition,
-    update_competition_winners,
 )
-from .models import CompleteCompetition, CreateCompetition, CreateInvoiceForTicket, UpdateCompetition
+from .models import Competition, CompleteCompetition, CreateCompetition, CreateInvoiceForTicket, TicketCount, UpdateCompetition
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # the json module is used instead
 
 # Competitions
 
 
+STREAM_PAGE_SIZE = 500
+
+# List responses at least this big are gzipped for clients that accept it
+GZIP_MIN_SIZE = 64 * 1024
+GZIP_LEVEL = 5
+
+# When set, ticket creation only checks the reward target's syntax, and resolves it after
+# the invoice is returned, so checkout doesn't wait on third party lnurl servers
+DEFER_REWARD_TARGET_CHECK = False
+
+# Keeps references to fire-and-forget tasks until they are done
+background_tasks: Set[asyncio.Task] = set()
+
+
+def parse_page_cursor(after: Optional[str]) -> Optional[Tuple[int, str]]:
+    # The cursor is "<time>:<id>" of the last item of the previous page
+    if after is None:
+        return None
+    after_time, _, after_id = after.partition(":")
+    if not after_time.isdigit() or not after_id:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid after cursor")
+    return int(after_time), after_id
+
+
+def dumps_json(value) -> bytes:
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+async def json_rows_response(request: Request, rows: List[dict]) -> Response:
+    body = dumps_json(rows)
+    if len(body) < GZIP_MIN_SIZE or "gzip" not in request.headers.get("accept-encoding", ""):
+        return Response(body, media_type="application/json")
+    # Compressing megabytes takes a while, so it is kept off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(None, gzip.compress, body, GZIP_LEVEL)
+    return Response(
+        body,
+        media_type="application/json",
+        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+    )
+
+
+def stream_ndjson(get_page, after: Optional[Tuple[int, str]]) -> StreamingResponse:
+    async def pages():
+        page_after = after
+        while True:
+            page = await get_page(STREAM_PAGE_SIZE, page_after)
+            if page:
+                yield b"".join(dumps_json(row) + b"\n" for row in page)
+            if len(page) < STREAM_PAGE_SIZE:
+                return
+            page_after = (page[-1]["time"], page[-1]["id"])
+
+    return StreamingResponse(pages(), media_type="application/x-ndjson")
+
+
 @bets4sats_ext.get("/api/v1/competitions")
 async def api_competitions(
-    all_wallets: bool = Query(False), wallet: WalletTypeInfo = Depends(get_key_type)
+    request: Request,
+    all_wallets: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1),
+    after: Optional[str] = Query(None),
+    ndjson: bool = Query(False),
+    wallet: WalletTypeInfo = Depends(get_key_type),
 ):
     wallet_ids = [wallet.wallet.id]
 
@@ -46,7 +120,13 @@ async def api_competitions(
         user = await get_user(wallet.wallet.user)
         wallet_ids = user.wallet_ids if user else []
 
-    return [competition.dict() for competition in await get_competitions(wallet_ids)]
+    after_cursor = parse_page_cursor(after)
+    if ndjson:
+        return stream_ndjson(
+            lambda page_limit, page_after: get_competition_rows(wallet_ids, page_limit, page_after),
+            after_cursor,
+        )
+    return await json_rows_response(request, await get_competition_rows(wallet_ids, limit, after_cursor))
 
 
 @bets4sats_ext.post("/api/v1/competitions")
@@ -58,6 +138,11 @@ async def api_competition_create(data: CreateCompetition):
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Choices title must be a non-empty string")
     if len(choices) < 2:
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Must have at least 2 choices")
+    if not is_banner_valid(data.banner):
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="Banner must be an http(s) url or a data url of a png, jpeg, gif or webp image",
+        )
     try:
         datetime.strptime(data.closing_datetime, "%Y-%m-%dT%H:%M:%S.%fZ")
     except:
@@ -105,28 +190,78 @@ async def api_competition_complete(data: CompleteCompetition, competition_id: st
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Not your competition"
         )
-    cas_result = await cas_competition_state(competition_id, "INITIAL", "COMPLETED_PAYING")
-    if not cas_result:
-        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="competition already completed")
-    # refetch competition after cas
-    competition = await get_competition(competition_id)
     choices = json.loads(competition.choices)
     if data.winning_choice >= len(choices):
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="winning_choice too high")
     if data.winning_choice >= 0 and choices[data.winning_choice]["total"] == 0:
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="no bet on winning choice")
-    for choice in choices:
-        choice["pre_agg_total"] = choice["total"]
-        choice["total"] = 0
-    choice_amount_sums = await sum_choices_amounts(competition.id)
-    for choice_amount_sum in choice_amount_sums:
-        choices[choice_amount_sum.choice]["total"] = choice_amount_sum.amount_sum
-    await update_competition_winners(competition_id, json.dumps(choices), data.winning_choice)
-    unpaid_tickets = await get_state_competition_tickets(competition_id, ["WON_UNPAID", "CANCELLED_UNPAID"])
-    for ticket in unpaid_tickets:
-        reward_ticket_ids_queue.put_nowait(ticket.id)
+    # The winning choice and payout mode are stored with the state change, so that the
+    # settlement is resumed by resume_settlements if this process stops before it is done
+    if not await complete_competition(competition_id, data.winning_choice, data.aggregate_payouts):
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="competition already completed")
     competition = await get_competition(competition_id)
-    return competition.dict()
+    # Winners and payouts are settled in the background, see api_competition_settlement for progress
+    settlement = start_settlement(competition_id, data.winning_choice, data.aggregate_payouts)
+    return {**competition.dict(), "settlement": settlement}
+
+async def get_settling_competition(competition_id: str, wallet: WalletTypeInfo) -> Competition:
+    competition = await get_competition(competition_id)
+    if not competition:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="competition not found")
+    if competition.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your competition"
+        )
+    return competition
+
+@bets4sats_ext.get("/api/v1/competitions/{competition_id}/settlement")
+async def api_competition_settlement(competition_id: str, wallet: WalletTypeInfo = Depends(get_key_type)):
+    await get_settling_competition(competition_id, wallet)
+    settlement = settlement_jobs.get(competition_id)
+    if not settlement:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="no settlement running in this process")
+    return settlement
+
+@bets4sats_ext.post("/api/v1/competitions/{competition_id}/settlement")
+async def api_competition_settlement_retry(competition_id: str, wallet: WalletTypeInfo = Depends(get_key_type)):
+    # Retries a failed settlement, or resumes one that was interrupted elsewhere
+    competition = await get_settling_competition(competition_id, wallet)
+    if competition.state != "COMPLETED_PAYING":
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="competition is not being paid")
+    return start_settlement(competition_id, competition.winning_choice, competition.settle_aggregate)
+
+@bets4sats_ext.get("/api/v1/competitions/{competition_id}/odds")
+async def api_competition_odds(request: Request, competition_id: str):
+    # get_competition is served from the in-process cache, so unchanged polls do no db work
+    competition = await get_competition(competition_id)
+    if not competition:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist.")
+    etag = f'W/"{competition.sold}-{competition.state}-{competition.winning_choice}-{zlib.crc32(competition.choices.encode())}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    choices = json.loads(competition.choices)
+    pool = sum(choice["total"] for choice in choices)
+    prize_pool = pool * (100 - PRIZE_FEE_PERCENT) / 100
+    return JSONResponse(
+        {
+            "state": competition.state,
+            "sold": competition.sold,
+            "winning_choice": competition.winning_choice,
+            "total": pool,
+            "choices": [
+                {
+                    "title": choice["title"],
+                    "total": choice["total"],
+                    # decimal odds: the reward per sat bet, if this choice wins
+                    "odds": prize_pool / choice["total"] if choice["total"] else None,
+                }
+                for choice in choices
+            ],
+        },
+        headers=headers,
+    )
 
 @bets4sats_ext.delete("/api/v1/competitions/{competition_id}")
 async def api_form_delete(competition_id, wallet: WalletTypeInfo = Depends(get_key_type)):
@@ -149,7 +284,12 @@ async def api_form_delete(competition_id, wallet: WalletTypeInfo = Depends(get_k
 
 @bets4sats_ext.get("/api/v1/tickets")
 async def api_tickets(
-    all_wallets: bool = Query(False), wallet: WalletTypeInfo = Depends(get_key_type)
+    request: Request,
+    all_wallets: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1),
+    after: Optional[str] = Query(None),
+    ndjson: bool = Query(False),
+    wallet: WalletTypeInfo = Depends(get_key_type),
 ):
     wallet_ids = [wallet.wallet.id]
 
@@ -157,7 +297,13 @@ async def api_tickets(
         user = await get_user(wallet.wallet.user)
         wallet_ids = user.wallet_ids if user else []
 
-    return [ticket.dict() for ticket in await get_tickets(wallet_ids)]
+    after_cursor = parse_page_cursor(after)
+    if ndjson:
+        return stream_ndjson(
+            lambda page_limit, page_after: get_ticket_rows(wallet_ids, page_limit, page_after),
+            after_cursor,
+        )
+    return await json_rows_response(request, await get_ticket_rows(wallet_ids, limit, after_cursor))
 
 
 @bets4sats_ext.post("/api/v1/tickets/{competition_id}")
@@ -180,7 +326,14 @@ async def api_ticket_make_ticket(competition_id, data: CreateInvoiceForTicket):
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Invalid choice"
         )
-    if data.reward_target:
+    reward_target_status = "VALID"
+    if data.reward_target and DEFER_REWARD_TARGET_CHECK:
+        if not is_reward_target_well_formed(data.reward_target):
+            raise HTTPException(
+                status_code=HTTPStatus.FORBIDDEN, detail="Bad lightning address, lnurl-pay or wallet-id"
+            )
+        reward_target_status = "PENDING"
+    elif data.reward_target:
         try:
             await get_lnurlp_parameters(data.reward_target)
         except Exception as error:
@@ -191,21 +344,35 @@ async def api_ticket_make_ticket(competition_id, data: CreateInvoiceForTicket):
     ticket_id = shortuuid.random()
     payment_request = None
     try:
-        _payment_hash, payment_request = await create_invoice(
+        payment_hash, payment_request = await create_invoice(
             expiry=INVOICE_EXPIRY,
             wallet_id=competition.wallet,
             amount=data.amount,
             memo=f"Bets4SatsTicketId:{competition_id}.{ticket_id}",
             extra={"tag": "bets4sats", "reward_target": data.reward_target, "choice": data.choice},
         )
-        await create_ticket(
+        ticket = await create_ticket(
             ticket_id=ticket_id,
             wallet=competition.wallet,
             competition=competition_id,
             amount=data.amount,
             reward_target=str(data.reward_target),
-            choice=int(data.choice)
+            choice=int(data.choice),
+            payment_hash=payment_hash,
+            reward_target_status=reward_target_status,
         )
+        if not ticket:
+            raise HTTPException(
+                status_code=HTTPStatus.FORBIDDEN,
+                detail="Competition is close for new tickets."
+            )
+        ticket_created_event.set()
+        if reward_target_status == "PENDING":
+            task = asyncio.create_task(verify_ticket_reward_target(ticket_id, data.reward_target))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e))
     return {"ticket_id": ticket_id, "payment_request": payment_request}
@@ -216,6 +383,45 @@ async def api_ticket_send_ticket(competition_id, ticket_id):
     response = await send_ticket(competition_id, ticket_id)
     return response
 
+SSE_KEEPALIVE_INTERVAL = 20
+
+@bets4sats_ext.get("/api/v1/tickets/{competition_id}/{ticket_id}/sse")
+async def api_ticket_paid_events(request: Request, competition_id, ticket_id):
+    ticket = await get_ticket(ticket_id)
+    if not ticket or ticket.competition != competition_id:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="Ticket could not be fetched, or invoice has expired.",
+        )
+
+    async def events():
+        # Subscribe before re-checking the state, so a payment in between is not missed
+        queue = subscribe_ticket_paid(ticket_id)
+        try:
+            current_ticket = await get_ticket(ticket_id)
+            if current_ticket and current_ticket.state != "INITIAL":
+                yield "event: paid\ndata: {}\n\n"
+                return
+            deadline = asyncio.get_running_loop().time() + INVOICE_EXPIRY
+            while asyncio.get_running_loop().time() < deadline:
+                if await request.is_disconnected():
+                    return
+                try:
+                    await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "event: paid\ndata: {}\n\n"
+                return
+        finally:
+            unsubscribe_ticket_paid(ticket_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @bets4sats_ext.delete("/api/v1/tickets/{ticket_id}")
 async def api_ticket_delete(ticket_id, wallet: WalletTypeInfo = Depends(get_key_type)):
     ticket = await get_ticket(ticket_id)
@@ -235,16 +441,13 @@ async def api_ticket_delete(ticket_id, wallet: WalletTypeInfo = Depends(get_key_
 
 
 @bets4sats_ext.get("/api/v1/competitiontickets/{competition_id}/{register_id}")
-async def api_competition_tickets(competition_id, register_id):
+async def api_competition_tickets(request: Request, competition_id, register_id, since: Optional[int] = Query(None, ge=0)):
     competition = await get_competition(competition_id)
     if competition is None or not hmac.compare_digest(competition.register_id, register_id):
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Competition does not exist."
         )
-    return [
-        ticket.dict()
-        for ticket in await get_wallet_competition_tickets(competition_id)
-    ]
+    return await json_rows_response(request, await get_wallet_competition_ticket_rows(competition_id, since))
 
 
 @bets4sats_ext.get("/api/v1/register/ticket/{ticket_id}")
@@ -256,3 +459,66 @@ async def api_competition_register_ticket(ticket_id):
         )
 
     return ticket.dict()
+
+
+# Summary
+
+
+def summarize_ticket_counts(ticket_counts: List[TicketCount], key: str) -> List[Dict]:
+    summaries: Dict[str, Dict] = {}
+    for ticket_count in ticket_counts:
+        summary = summaries.setdefault(getattr(ticket_count, key), {
+            key: getattr(ticket_count, key),
+            "tickets": {},
+            "funded_sats": 0,
+            "paid_msat": 0,
+            "failed_payouts": 0,
+        })
+        summary["tickets"][ticket_count.state] = summary["tickets"].get(ticket_count.state, 0) + ticket_count.tickets
+        if ticket_count.state != "INITIAL":
+            summary["funded_sats"] += ticket_count.amount
+        if ticket_count.state.endswith("_PAID"):
+            summary["paid_msat"] += ticket_count.reward_msat
+        if ticket_count.state.endswith("_PAYMENT_FAILED"):
+            summary["failed_payouts"] += ticket_count.tickets
+    return list(summaries.values())
+
+
+@bets4sats_ext.get("/api/v1/summary")
+async def api_summary(all_wallets: bool = Query(False), wallet: WalletTypeInfo = Depends(get_key_type)):
+    wallet_ids = [wallet.wallet.id]
+
+    if all_wallets:
+        user = await get_user(wallet.wallet.user)
+        wallet_ids = user.wallet_ids if user else []
+
+    ticket_counts = await get_ticket_counts(wallet_ids)
+    return {
+        "wallets": summarize_ticket_counts(ticket_counts, "wallet"),
+        "competitions": summarize_ticket_counts(ticket_counts, "competition"),
+    }
+
+
+# Payouts
+
+
+@bets4sats_ext.get("/api/v1/payouts/stats")
+async def api_payout_stats(user: User = Depends(check_admin)):
+    return await get_payout_stats()
+
+
+@bets4sats_ext.get("/api/v1/metrics")
+async def api_metrics(user: User = Depends(check_admin)):
+    payout_stats = await get_payout_stats()
+    return PlainTextResponse(
+        metrics.render_prometheus({
+            "bets4sats_payout_queue_depth": ("Payouts waiting in the outbox", payout_stats["queue_depth"]),
+            "bets4sats_payouts_in_flight": ("Payouts being paid by this process", payout_stats["in_flight"]),
+            **{
+                f"bets4sats_{name}_cache_{key}": (f"{name.capitalize()} cache {key.replace('_', ' ')}", value)
+                for name, cache in (("competition", competition_cache), ("lnurlp", lnurlp_cache))
+                for key, value in cache.stats().items()
+            },
+        }),
+        media_type="text/plain; version=0.0.4",
+    )